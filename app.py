@@ -3,10 +3,13 @@ import dash_design_kit as ddk
 from dash import dcc, html, Input, Output, State
 import dash_leaflet as dl
 import dash_mantine_components as dmc
+import flask
 import warnings
-import pickle, json
+import io, json
+import numpy as np
+from PIL import Image
 
-from constants import redis_instance, BUTTON_STYLE, REDIS_EXPIRE_SEC
+from constants import BUTTON_STYLE
 from utils.layout_utils import (
     analysis_modal,
     details_modal,
@@ -14,13 +17,49 @@ from utils.layout_utils import (
     use_cases_modal,
 )
 from utils.data_utils import (
+    aggregate_class_stats,
+    images_in_bbox,
+    load_class_stats,
     update_df,
     get_image,
     to_geojson,
-    kmeans_cluster,
-    calculate_class_proportions,
-    create_colored_mask_image,
-    process_img,
+)
+from utils.prefetch_utils import prefetch, prefetch_stats
+from utils.profiling_utils import (
+    profiled,
+    require_admin,
+    slow_call,
+    slow_calls,
+)
+from utils.rate_limit import limiter_stats
+from utils.server_utils import configure_compression, register_payload_budgets
+from utils.coverage_utils import render_tile
+from utils.export_utils import (
+    image_bounds,
+    stream_cog_archive,
+    stream_file,
+    write_cog,
+)
+from utils.progressive_utils import (
+    get_batch_progress,
+    get_progress,
+    start_batch_classification,
+    start_progressive_classification,
+)
+from utils.scheduler import classification_scheduler
+from utils.storage_backends import backend
+from utils.storage_utils import (
+    catalog_version,
+    delete_image,
+    exists,
+    load,
+    load_array,
+    storage_usage,
+)
+from utils.tenant_utils import (
+    job_slot,
+    register_tenants,
+    TenantQuotaExceeded,
 )
 
 # Temporary -- muting pandas warnings for using df.append()
@@ -29,6 +68,9 @@ warnings.simplefilter(action="ignore", category=FutureWarning)
 app = dash.Dash(__name__, prevent_initial_callbacks="initial_duplicate")
 app.title = "Land cover analysis and classification"
 server = app.server  # expose server variable for Procfile
+configure_compression(server)
+register_payload_budgets(server)
+register_tenants(server)
 
 app.layout = dmc.NotificationsProvider(
     ddk.App(
@@ -54,20 +96,35 @@ app.layout = dmc.NotificationsProvider(
 )
 
 
-@app.callback(Output("content", "children"), Input("url", "pathname"))
-def load_layout(url):
-    return layout()
+@app.callback(
+    Output("image-options", "rowData", allow_duplicate=True),
+    Output("geojson", "data", allow_duplicate=True),
+    Input("url", "pathname"),
+)
+@profiled
+def load_catalog(url):
+    df = update_df()
+    return df.to_dict("records"), to_geojson(df)
 
 
 @app.callback(
     Output("lat", "value"),
     Output("lon", "value"),
     Input("edit-control", "geojson"),
+    State("my-date-picker", "date"),
+    State("img-dim", "value"),
 )
-def point_fill(geojson):
+@profiled
+def point_fill(geojson, date, dim):
     if geojson and len(geojson["features"]) > 0:
         lon, lat = geojson["features"][0]["geometry"]["coordinates"]
-        return round(lat, 2), round(lon, 2)
+        lat, lon = round(lat, 2), round(lon, 2)
+        try:
+            prefetch(lat, lon, dim, date)
+        except Exception as e:
+            # Prefetching is speculative, it must never get in the way
+            print(f"Prefetch not started: {e}")
+        return lat, lon
     return dash.no_update, dash.no_update
 
 
@@ -79,6 +136,7 @@ def point_fill(geojson):
     State("analyze-modal", "opened"),
     State("image-options", "selectedRows"),
 )
+@profiled
 def modal_classify(n_clicks, opened, selected):
     if n_clicks and selected:
         return not opened, analysis_modal(), dash.no_update
@@ -89,7 +147,7 @@ def modal_classify(n_clicks, opened, selected):
             dmc.Notification(
                 id="classify-notfication",
                 action="show",
-                message="Can't classify. Please select an image from the table.",
+                message="Can't classify. Please select one or more images from the table.",
             ),
         )
     return dash.no_update, dash.no_update, dash.no_update
@@ -100,10 +158,23 @@ def modal_classify(n_clicks, opened, selected):
     Input("use-cases", "n_clicks"),
     prevent_initial_call=True,
 )
+@profiled
 def modal_use_cases(n_clicks):
     return True
 
 
+def _first_selected_notification(id, action, selection):
+    # Display and investigate show a single image
+    return dmc.Notification(
+        id=id,
+        action="show",
+        message=(
+            f"{action} {selection[0]['id']} only, the first of the "
+            f"{len(selection)} selected images."
+        ),
+    )
+
+
 @app.callback(
     Output("details-modal", "opened"),
     Output("details-modal", "children"),
@@ -112,16 +183,15 @@ def modal_use_cases(n_clicks):
     State("details-modal", "opened"),
     State("image-options", "selectedRows"),
 )
+@profiled
 def modal_details(n_clicks, opened, selected):
     if n_clicks and selected:
         img_id = selected[0]["id"]
-        if redis_instance.exists(f"{img_id}_classified") == 1:
+        if exists(f"{img_id}_classified"):
             class_proportions = selected[0]["class distribution"]
 
             try:
-                class_colors = json.loads(
-                    redis_instance.get(f"{img_id}_class_colors")
-                )
+                class_colors = json.loads(load(f"{img_id}_class_colors"))
                 class_colors = [
                     f"rgb({tuple(color)})" for color in class_colors
                 ]
@@ -136,10 +206,22 @@ def modal_details(n_clicks, opened, selected):
                     ),
                 )
 
+            class_stats = load_class_stats(img_id)
+            if class_stats is not None:
+                class_proportions = np.round(
+                    np.asarray(class_stats["pixels"])
+                    / sum(class_stats["pixels"]),
+                    3,
+                )
+            notification = dash.no_update
+            if len(selected) > 1:
+                notification = _first_selected_notification(
+                    "investigate-notfication", "Investigating", selected
+                )
             return (
                 not opened,
-                details_modal(class_proportions, class_colors),
-                dash.no_update,
+                details_modal(class_proportions, class_colors, class_stats),
+                notification,
             )
         else:
             return (
@@ -172,13 +254,26 @@ def modal_details(n_clicks, opened, selected):
     Input("display", "n_clicks"),
     State("image-options", "selectedRows"),
 )
+@profiled
 def img_display(n_clicks, selection):
     if n_clicks and selection:
         img_id = selection[0]["id"]
         lat = float(selection[0]["lat"])
         lon = float(selection[0]["lon"])
         dim = float(selection[0]["dim"])
-        img = pickle.loads(redis_instance.get(img_id))
+        img = load_array(img_id, replica=True)
+        # The image may have expired or been evicted since it was listed
+        if img is None:
+            return (
+                dash.no_update,
+                dash.no_update,
+                dmc.Notification(
+                    id="display-notfication",
+                    action="show",
+                    message=f"Can't display. {img_id} is no longer stored.",
+                ),
+            )
+        img = Image.fromarray(img)
 
         image_bounds = [
             [(lat - (dim / 2)), (lon - ((dim / 2)))],
@@ -192,20 +287,23 @@ def img_display(n_clicks, selection):
         )
 
         layer_classified = None
-        if redis_instance.exists(f"{img_id}_classified") == 1:
-            img_classified = pickle.loads(
-                redis_instance.get(f"{img_id}_classified")
-            )
+        img_classified = load_array(f"{img_id}_classified", replica=True)
+        if img_classified is not None:
             layer_classified = dl.ImageOverlay(
                 opacity=0.95,
-                url=img_classified,
+                url=Image.fromarray(img_classified),
                 bounds=image_bounds,
             )
 
+        notification = dash.no_update
+        if len(selection) > 1:
+            notification = _first_selected_notification(
+                "display-notfication", "Displaying", selection
+            )
         return (
             layer_img,
-            layer_classified,
-            dash.no_update,
+            layer_classified or [],
+            notification,
         )
     elif n_clicks and not selection:
         return (
@@ -230,24 +328,24 @@ def img_display(n_clicks, selection):
     Input("delete", "n_clicks"),
     State("image-options", "selectedRows"),
 )
+@profiled
 def img_delete(n_clicks, selection):
     if n_clicks and selection:
-        img_id = selection[0]["id"]
-        for key in [img_id, f"{img_id}_metadata", f"{img_id}_classified"]:
-            if redis_instance.exists(key) == 1:
-                redis_instance.delete(key)
+        img_ids = [row["id"] for row in selection]
+        for img_id in img_ids:
+            delete_image(img_id)
         df = update_df()
         return (
             df.to_dict("records"),
             to_geojson(df),
+            [],
+            [],
+            [],
             dmc.Notification(
                 id="delete-notfication",
                 action="show",
-                message=f"{img_id} successfully deleted.",
+                message=f"{', '.join(img_ids)} successfully deleted.",
             ),
-            None,
-            None,
-            None,
         )
     elif n_clicks and not selection:
         return (
@@ -276,53 +374,268 @@ def img_delete(n_clicks, selection):
     Output("analyze-run-notify", "children"),
     Output("analyze-modal", "opened", allow_duplicate=True),
     Output("image-options", "rowData", allow_duplicate=True),
+    Output("classify-job", "data"),
+    Output("classify-poll", "disabled"),
     Input("run-analysis", "n_clicks"),
     State("image-options", "selectedRows"),
     State("model-select", "value"),
     State("n-classes", "value"),
+    State("enhancement", "value"),
+    State("progressive", "checked"),
     State("analyze-modal", "opened"),
 )
-def img_classify(n_clicks, selection, model, n_classes, opened):
+@profiled
+def img_classify(
+    n_clicks, selection, model, n_classes, enhancement, progressive, opened
+):
     if n_clicks and selection:
-        img_id = selection[0]["id"]
-        img = pickle.loads(redis_instance.get(img_id))
-        image_array = process_img(img)
-        if model == "k-means":
-            segmentation = kmeans_cluster(image_array, n_classes)
-            class_proportions = calculate_class_proportions(
-                segmentation, n_classes
-            )
-            img_classified, class_colors = create_colored_mask_image(
-                segmentation, n_classes
+        try:
+            return _classify(
+                selection, model, n_classes, enhancement, progressive, opened
             )
-            img_info = pickle.loads(redis_instance.get(f"{img_id}_metadata"))
-            img_info["classified"] = model
-            img_info["n classes"] = n_classes
-            img_info["class distribution"] = class_proportions
-            redis_instance.set(f"{img_id}_metadata", pickle.dumps(img_info))
-            redis_instance.set(
-                f"{img_id}_classified", pickle.dumps(img_classified)
-            )
-            redis_instance.set(
-                f"{img_id}_class_colors", json.dumps(class_colors)
+        except TenantQuotaExceeded as e:
+            return (
+                dmc.Notification(
+                    id="analysis-done", action="show", message=str(e)
+                ),
+                dash.no_update,
+                dash.no_update,
+                dash.no_update,
+                dash.no_update,
             )
+    return (
+        dash.no_update,
+        dash.no_update,
+        dash.no_update,
+        dash.no_update,
+        dash.no_update,
+    )
 
-            redis_instance.expire(f"{img_id}_class_colors", REDIS_EXPIRE_SEC)
-            redis_instance.expire(f"{img_id}_metadata", REDIS_EXPIRE_SEC)
-            message = "Image classification successfully completed."
-        else:
-            message = (
-                f"{model} not yet supported. Classification not completed."
-            )
 
+def _classify(selection, model, n_classes, enhancement, progressive, opened):
+    if model == "k-means" and progressive and len(selection) == 1:
+        row = selection[0]
+        start_progressive_classification(row["id"], n_classes, enhancement)
+        job = {
+            "img_id": row["id"],
+            "bounds": image_bounds(
+                float(row["lat"]), float(row["lon"]), float(row["dim"])
+            ),
+            "sent": -1,
+        }
+        return (
+            dmc.Notification(
+                id="analysis-done",
+                action="show",
+                message="Classification started, previews will follow.",
+            ),
+            not opened,
+            dash.no_update,
+            job,
+            False,
+        )
+    elif model == "k-means":
+        img_ids = [row["id"] for row in selection]
+        job_id = start_batch_classification(
+            img_ids, model, n_classes, enhancement
+        )
         return (
             dmc.Notification(
-                id="analysis-done", action="show", message=message
+                id="analysis-progress",
+                action="show",
+                message=f"Classifying {len(img_ids)} image(s)...",
+                loading=True,
+                autoClose=False,
             ),
             not opened,
+            dash.no_update,
+            {"batch": job_id},
+            False,
+        )
+    else:
+        message = f"{model} not yet supported. Classification not completed."
+
+    return (
+        dmc.Notification(id="analysis-done", action="show", message=message),
+        not opened,
+        update_df().to_dict("records"),
+        dash.no_update,
+        dash.no_update,
+    )
+
+
+def _overlay_bounds(job_bounds, shape, pixel_box=None):
+    # Leaflet bounds of a pixel box of the image, the whole image by default
+    west, south, east, north = job_bounds
+    height, width = shape
+    row0, col0, row1, col1 = pixel_box or (0, 0, height, width)
+    lat_step, lon_step = (north - south) / height, (east - west) / width
+    return [
+        [north - row1 * lat_step, west + col0 * lon_step],
+        [north - row0 * lat_step, west + col1 * lon_step],
+    ]
+
+
+def _batch_progress(job):
+    progress = get_batch_progress(job["batch"])
+    if progress is None:
+        return dash.no_update, dash.no_update, False, dash.no_update, None
+    if "error" in progress:
+        return (
+            dash.no_update,
+            None,
+            True,
+            dash.no_update,
+            dmc.Notification(
+                id="analysis-progress",
+                action="update",
+                message=f"Classification failed: {progress['error']}",
+                loading=False,
+                autoClose=5000,
+            ),
+        )
+
+    classified, elapsed = progress["classified"], progress["elapsed"]
+    rate = classified / elapsed if elapsed else 0
+    if not progress["finished"]:
+        return (
+            dash.no_update,
+            job,
+            False,
+            dash.no_update,
+            dmc.Notification(
+                id="analysis-progress",
+                action="update",
+                message=(
+                    f"Classified {classified}/{progress['total']} image(s) "
+                    f"({rate:.2f} images/s)."
+                ),
+                loading=True,
+                autoClose=False,
+            ),
+        )
+    message = (
+        f"Classification of {classified} image(s) completed in "
+        f"{elapsed:.1f}s ({rate:.2f} images/s)."
+    )
+    missing = progress["missing"]
+    if missing:
+        message += (
+            f" Skipped {len(missing)} image(s) no longer stored: "
+            f"{', '.join(missing)}."
+        )
+    return (
+        dash.no_update,
+        None,
+        True,
+        update_df().to_dict("records"),
+        dmc.Notification(
+            id="analysis-progress",
+            action="update",
+            message=message,
+            loading=False,
+            autoClose=5000,
+        ),
+    )
+
+
+@app.callback(
+    Output("classified-img", "children", allow_duplicate=True),
+    Output("classify-job", "data", allow_duplicate=True),
+    Output("classify-poll", "disabled", allow_duplicate=True),
+    Output("image-options", "rowData", allow_duplicate=True),
+    Output("analyze-run-notify", "children", allow_duplicate=True),
+    Input("classify-poll", "n_intervals"),
+    State("classify-job", "data"),
+)
+@profiled
+def classify_progress(n_intervals, job):
+    if not job:
+        return dash.no_update, dash.no_update, True, dash.no_update, None
+    if "batch" in job:
+        return _batch_progress(job)
+    progress, coarse, tiles = get_progress(job["img_id"], job["sent"])
+    if progress is None:
+        return dash.no_update, dash.no_update, False, dash.no_update, None
+    if "error" in progress:
+        return (
+            dash.no_update,
+            None,
+            True,
+            dash.no_update,
+            dmc.Notification(
+                id="analysis-done",
+                action="show",
+                message=(
+                    f"Classification of {job['img_id']} failed: "
+                    f"{progress['error']}"
+                ),
+            ),
+        )
+    if progress.get("expired"):
+        return (
+            dash.no_update,
+            None,
+            True,
+            dash.no_update,
+            dmc.Notification(
+                id="analysis-done",
+                action="show",
+                message=(
+                    f"Previews of {job['img_id']} expired, the "
+                    "classification carries on in the background."
+                ),
+            ),
+        )
+
+    full_shape = (progress["tiles"][-1][2], progress["tiles"][-1][3])
+    overlays = [
+        dl.ImageOverlay(
+            opacity=0.95,
+            url=Image.fromarray(tile),
+            bounds=_overlay_bounds(job["bounds"], full_shape, box),
+        )
+        for box, tile in tiles
+    ]
+    if coarse is not None:
+        children = [
+            dl.ImageOverlay(
+                opacity=0.95,
+                url=Image.fromarray(coarse),
+                bounds=_overlay_bounds(job["bounds"], full_shape),
+            )
+        ] + overlays
+    else:
+        children = dash.Patch()
+        for overlay in overlays:
+            children.append(overlay)
+
+    job = {**job, "sent": progress["done"]}
+    if progress["finished"]:
+        # The stored result replaces the stack of previews
+        classified = load_array(f"{job['img_id']}_classified", replica=True)
+        if classified is not None:
+            children = [
+                dl.ImageOverlay(
+                    opacity=0.95,
+                    url=Image.fromarray(classified),
+                    bounds=_overlay_bounds(
+                        job["bounds"], classified.shape[:2]
+                    ),
+                )
+            ]
+        return (
+            children,
+            None,
+            True,
             update_df().to_dict("records"),
+            dmc.Notification(
+                id="analysis-done",
+                action="show",
+                message=f"Classification of {job['img_id']} completed.",
+            ),
         )
-    return dash.no_update, dash.no_update, dash.no_update
+    return children, job, False, dash.no_update, dash.no_update
 
 
 @app.callback(
@@ -330,17 +643,34 @@ def img_classify(n_clicks, selection, model, n_classes, opened):
     Output("map-view", "zoom"),
     Output("satellite-img", "children", allow_duplicate=True),
     Output("classified-img", "children", allow_duplicate=True),
+    Output("classify-job", "data", allow_duplicate=True),
+    Output("classify-poll", "disabled", allow_duplicate=True),
     Input("image-options", "selectedRows"),
+    State("classify-job", "data"),
 )
-def row_select(selection):
+@profiled
+def row_select(selection, job):
     if selection:
+        # Previews of a running classification are dropped with the overlays,
+        # the classification itself carries on in the background. Batches
+        # have no previews and keep reporting their progress
+        keep_polling = bool(job) and "batch" in job
         return (
             (float(selection[0]["lat"]), float(selection[0]["lon"])),
             12,
-            None,
-            None,
+            [],
+            [],
+            dash.no_update if keep_polling else None,
+            dash.no_update if keep_polling else True,
         )
-    return dash.no_update, dash.no_update, dash.no_update, dash.no_update
+    return (
+        dash.no_update,
+        dash.no_update,
+        dash.no_update,
+        dash.no_update,
+        dash.no_update,
+        dash.no_update,
+    )
 
 
 @app.callback(
@@ -354,9 +684,14 @@ def row_select(selection):
     State("img-dim", "value"),
     State("name", "value"),
 )
+@profiled
 def data_retrieve(n_clicks, date, lat, lon, dim, name):
     if n_clicks:
-        msg = get_image(lat, lon, dim, name, date)
+        try:
+            with job_slot():
+                msg = get_image(lat, lon, dim, name, date)
+        except TenantQuotaExceeded as e:
+            msg = str(e)
         df = update_df()
         return (
             dmc.Notification(id="update", action="show", message=msg),
@@ -366,5 +701,133 @@ def data_retrieve(n_clicks, date, lat, lon, dim, name):
     return dash.no_update, dash.no_update, dash.no_update
 
 
+@app.callback(
+    Output("coverage", "url"),
+    Input("image-options", "rowData"),
+)
+@profiled
+def coverage_url(rows):
+    # Versioned so the browser drops tiles cached before the catalog changed
+    return f"/api/coverage/{{z}}/{{x}}/{{y}}.png?v={catalog_version()}"
+
+
+@app.callback(
+    Output("export-link", "href"),
+    Input("image-options", "selectedRows"),
+)
+@profiled
+def export_link(selection):
+    if not selection:
+        return None
+    if len(selection) == 1:
+        return f"/api/export/{selection[0]['id']}.tif"
+    return "/api/export?ids=" + ",".join(row["id"] for row in selection)
+
+
+@server.route("/api/storage/usage")
+def storage_usage_report():
+    # Lists the namespaces and largest images of every tenant
+    require_admin()
+    usage = storage_usage()
+    # Classification jobs waiting in the scheduler of this worker, by tenant
+    usage["queued_jobs"] = classification_scheduler.queue_depths()
+    return flask.jsonify(usage)
+
+
+@server.route("/api/redis/pools")
+def redis_pools():
+    require_admin()
+    return flask.jsonify(backend.pool_stats())
+
+
+@server.route("/api/prefetch/stats")
+def prefetch_report():
+    require_admin()
+    return flask.jsonify(prefetch_stats())
+
+
+@server.route("/api/nasa/limits")
+def nasa_limits():
+    require_admin()
+    return flask.jsonify(limiter_stats())
+
+
+@server.route("/admin/slow-calls")
+def slow_calls_report():
+    require_admin()
+    return flask.jsonify(slow_calls())
+
+
+@server.route("/admin/slow-calls/<call_id>")
+def slow_call_report(call_id):
+    require_admin()
+    call = slow_call(call_id)
+    if call is None:
+        flask.abort(404)
+    return flask.jsonify(call)
+
+
+@server.route("/api/aggregate/classes")
+def aggregate_classes():
+    args = flask.request.args
+    if "bbox" in args:
+        try:
+            west, south, east, north = map(float, args["bbox"].split(","))
+        except ValueError:
+            flask.abort(400)
+        img_ids = images_in_bbox(west, south, east, north)
+    else:
+        img_ids = [x for x in args.get("ids", "").split(",") if x]
+        if not img_ids:
+            flask.abort(400)
+    return flask.jsonify(aggregate_class_stats(img_ids))
+
+
+@server.route("/api/coverage/<int:z>/<int:x>/<int:y>.png")
+def coverage_tile(z, x, y):
+    if not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        flask.abort(404)
+    response = flask.Response(render_tile(z, x, y), mimetype="image/png")
+    response.cache_control.private = True
+    response.cache_control.max_age = 600
+    return response
+
+
+@server.route("/api/thumbnail/<path:img_id>.png")
+def thumbnail(img_id):
+    thumb = load_array(f"{img_id}_thumb", touch=False)
+    if thumb is None:
+        flask.abort(404)
+    buffer = io.BytesIO()
+    Image.fromarray(thumb).save(buffer, format="PNG")
+    response = flask.Response(buffer.getvalue(), mimetype="image/png")
+    response.cache_control.private = True
+    response.cache_control.max_age = 3600
+    return response
+
+
+@server.route("/api/export/<path:img_id>.tif")
+def export_image(img_id):
+    if not exists(f"{img_id}_metadata"):
+        flask.abort(404)
+    return flask.Response(
+        stream_file(write_cog(img_id)),
+        mimetype="image/tiff",
+        headers={"Content-Disposition": f"attachment; filename={img_id}.tif"},
+    )
+
+
+@server.route("/api/export")
+def export_images():
+    img_ids = [x for x in flask.request.args.get("ids", "").split(",") if x]
+    if not img_ids:
+        flask.abort(400)
+    return flask.Response(
+        flask.stream_with_context(stream_cog_archive(img_ids)),
+        mimetype="application/zip",
+        headers={"Content-Disposition": "attachment; filename=export.zip"},
+    )
+
+
 if __name__ == "__main__":
     app.run_server(debug=True)
@@ -0,0 +1,12 @@
+var dagcomponentfuncs = (window.dashAgGridComponentFunctions =
+  window.dashAgGridComponentFunctions || {});
+
+dagcomponentfuncs.ImageThumbnail = function (props) {
+  if (!props.data || !props.data.id) {
+    return null;
+  }
+  return React.createElement("img", {
+    src: "/api/thumbnail/" + encodeURI(props.data.id) + ".png",
+    style: { height: "100%", objectFit: "contain" },
+  });
+};
@@ -1,6 +1,8 @@
-import os
+import functools, os, secrets
 import dash
 import redis
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -19,7 +21,19 @@ GRID_HEIGHT = "250px"
 PANEL_HEIGHT = "325px"
 
 COLUMN_DEFS = [
-    {"field": "name", "checkboxSelection": True},
+    {
+        "headerName": "preview",
+        "cellRenderer": "ImageThumbnail",
+        "sortable": False,
+        "filter": False,
+        "maxWidth": 90,
+    },
+    {
+        "field": "name",
+        "checkboxSelection": True,
+        "headerCheckboxSelection": True,
+        "headerCheckboxSelectionFilteredOnly": True,
+    },
     {"field": "id"},
     {"field": "date"},
     {"field": "lat"},
@@ -30,14 +44,179 @@ COLUMN_DEFS = [
     {"field": "class distribution"},
 ]
 
-REDIS_EXPIRE_SEC = 60 * 60 * 2  # Expire data in 2 hours
+REDIS_EXPIRE_SEC = 60 * 60 * 2  # Expire data in 2 hours, refreshed on access
 os.environ["REDIS_URL"] = os.environ.get("REDIS_URL", "redis://127.0.0.1:6379")
-redis_instance = redis.StrictRedis.from_url(
-    os.environ.get("REDIS_URL", "redis://127.0.0.1:6379")
+
+# Connection pool of each worker process: callers wait up to
+# REDIS_POOL_TIMEOUT_SEC for a free connection rather than opening more than
+# REDIS_MAX_CONNECTIONS. Idle connections are checked before reuse and
+# commands are retried with backoff across a failover
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 20))
+REDIS_POOL_TIMEOUT_SEC = 5
+REDIS_SOCKET_TIMEOUT_SEC = float(os.environ.get("REDIS_SOCKET_TIMEOUT", 5))
+REDIS_CONNECT_TIMEOUT_SEC = 2
+REDIS_HEALTH_CHECK_SEC = 30
+REDIS_RETRIES = 3
+
+# REDIS_CLUSTER=1 treats REDIS_URL as a node of a Redis Cluster. Large image
+# reads go to replicas, listed in REDIS_REPLICA_URLS or found in the cluster
+REDIS_CLUSTER = os.environ.get("REDIS_CLUSTER") == "1"
+REDIS_REPLICA_URLS = [
+    url for url in os.environ.get("REDIS_REPLICA_URLS", "").split(",") if url
+]
+
+
+def _redis_client(url, replica=False):
+    options = dict(
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT_SEC,
+        socket_timeout=REDIS_SOCKET_TIMEOUT_SEC,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT_SEC,
+        health_check_interval=REDIS_HEALTH_CHECK_SEC,
+        retry=Retry(ExponentialBackoff(cap=1, base=0.05), REDIS_RETRIES),
+        retry_on_error=[
+            redis.exceptions.ConnectionError,
+            redis.exceptions.TimeoutError,
+        ],
+    )
+    if REDIS_CLUSTER:
+        # RedisCluster drops the options its nodes do not take as client
+        # arguments, so those reach the pool of each node through its class
+        pool_options = {
+            key: options.pop(key)
+            for key in ["timeout", "health_check_interval", "retry_on_error"]
+        }
+        return redis.RedisCluster.from_url(
+            url,
+            connection_pool_class=functools.partial(
+                redis.BlockingConnectionPool, **pool_options
+            ),
+            cluster_error_retry_attempts=REDIS_RETRIES,
+            read_from_replicas=replica,
+            **options,
+        )
+    pool = redis.BlockingConnectionPool.from_url(url, **options)
+    return redis.StrictRedis(connection_pool=pool)
+
+
+redis_instance = _redis_client(os.environ["REDIS_URL"])
+if REDIS_CLUSTER:
+    redis_replicas = [_redis_client(os.environ["REDIS_URL"], replica=True)]
+else:
+    redis_replicas = [_redis_client(url) for url in REDIS_REPLICA_URLS]
+
+# Where imagery is stored: "redis", or "disk" for memory-mapped .npy files
+# and a SQLite metadata database under STORAGE_DIR
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "redis")
+STORAGE_DIR = os.environ.get("STORAGE_DIR", "data")
+
+# Memory budget of the image store (0 disables eviction) and the policy used
+# to pick images to evict when it is exceeded: "lru" or "lfu"
+STORAGE_BUDGET_BYTES = (
+    int(os.environ.get("STORAGE_BUDGET_MB", 512)) * 1024 ** 2
 )
+STORAGE_EVICTION_POLICY = os.environ.get("STORAGE_EVICTION_POLICY", "lru")
+
+# Responses smaller than this are sent uncompressed
+COMPRESS_MIN_BYTES = 1024
+
+# Uncompressed size above which a callback response is logged as a warning.
+# Outputs listed in PAYLOAD_BUDGETS ("<component id>.<property>") get their own
+PAYLOAD_BUDGET_BYTES = int(os.environ.get("PAYLOAD_BUDGET_KB", 256)) * 1024
+PAYLOAD_BUDGETS = {
+    "satellite-img.children": 4 * 1024 ** 2,
+    "classified-img.children": 4 * 1024 ** 2,
+    "image-options.rowData": 1024 ** 2,
+    "geojson.data": 1024 ** 2,
+}
+
+# Multi-user deployments: images are namespaced per tenant, a browser session
+# (cookie) or a user when TENANT_HEADER names a header set by an auth proxy.
+# Each tenant gets a storage quota (0 disables it) and a number of concurrent
+# jobs, and classification jobs are scheduled round-robin across tenants.
+# Storage is namespaced by an HMAC of the cookie or user keyed by
+# TENANT_SECRET, so namespaces can be listed without revealing sessions. When
+# unset a random secret is drawn at startup, and images stored before a
+# restart become unreachable. Job slots are leases, so the slots of jobs
+# killed before releasing them free up after TENANT_JOB_LEASE_SEC
+TENANT_COOKIE = "tenant"
+TENANT_HEADER = os.environ.get("TENANT_HEADER")
+TENANT_SECRET = os.environ.get("TENANT_SECRET") or secrets.token_hex(32)
+DEFAULT_TENANT = "public"
+TENANT_QUOTA_BYTES = int(os.environ.get("TENANT_QUOTA_MB", 128)) * 1024 ** 2
+TENANT_MAX_JOBS = int(os.environ.get("TENANT_MAX_JOBS", 2))
+TENANT_JOB_LEASE_SEC = 60 * 5
+CLASSIFY_JOB_WORKERS = 2
+
+# Opt-in profiling of Dash callbacks: calls slower than SLOW_CALLBACK_SEC are
+# recorded with their stage timings, and PROFILE_SAMPLE_RATE of all calls run
+# under cProfile so slow ones come with a profile. Recorded calls are kept for
+# SLOW_CALL_TTL_SEC and listed at /admin/slow-calls, which requires ADMIN_TOKEN
+PROFILE_CALLBACKS = os.environ.get("PROFILE_CALLBACKS") == "1"
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0.05))
+SLOW_CALLBACK_SEC = float(os.environ.get("SLOW_CALLBACK_SEC", 2))
+SLOW_CALL_TTL_SEC = 60 * 60 * 24
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
 
 NASA_KEY = os.getenv("NASA")
 
+# NASA API quota shared by all workers. Batch requests keep NASA_BATCH_RESERVE
+# tokens free for interactive downloads
+NASA_RATE_LIMIT_PER_HOUR = int(os.environ.get("NASA_RATE_LIMIT", 1000))
+NASA_RATE_LIMIT_BURST = 50
+NASA_BATCH_RESERVE = 10
+NASA_MAX_WAIT_SEC = 30
+
+# Asset metadata responses are cached, and fetched speculatively as soon as a
+# point is drawn on the map. PREFETCH_IMAGERY also downloads the image itself
+ASSET_CACHE_SEC = 60 * 30
+PREFETCH_IMAGERY = os.environ.get("PREFETCH_IMAGERY", "0") == "1"
+PREFETCH_WORKERS = 2
+
+# Resolutions precomputed at ingest time, alongside the full image
+THUMBNAIL_SIZE = (64, 64)
+CLASSIFY_SIZE = (256, 256)
+
+# Contrast enhancements that can be applied before classification, each
+# computed once per image and resolution and stored with the image
+ENHANCEMENTS = {
+    "none": "None",
+    "clahe": "CLAHE",
+    "stretch": "Percentile stretch",
+    "gamma": "Gamma",
+}
+CLAHE_CLIP_LIMIT = 3.1
+CLAHE_TILE_GRID = (10, 10)
+STRETCH_PERCENTILES = (2, 98)
+ENHANCE_GAMMA = 0.8  # Below 1 brightens dark imagery
+
+# Batch classification: processes used to predict images in parallel and the
+# number of pixels pooled across the selection to fit the shared model. Each
+# gunicorn worker (WEB_CONCURRENCY, see the Procfile) has one pool shared by
+# its CLASSIFY_JOB_WORKERS jobs, so by default the pools of all workers add
+# up to one process per core
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", 4))
+CLASSIFY_WORKERS = int(
+    os.environ.get(
+        "CLASSIFY_WORKERS", max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)
+    )
+)
+CLASSIFY_SAMPLE_PIXELS = int(os.environ.get("CLASSIFY_SAMPLE_PIXELS", 100000))
+
+# Coverage map: catalog footprints rendered into map tiles with datashader.
+# Tiles are cached until the catalog changes, for at most COVERAGE_TILE_SEC,
+# and colors saturate at COVERAGE_MAX_COUNT overlapping images
+COVERAGE_TILE_SIZE = 256
+COVERAGE_TILE_SEC = 60 * 10
+COVERAGE_MAX_COUNT = 10
+COVERAGE_CMAP = ["#fde725", "#21918c", "#440154"]
+
+# Tile size of the full-resolution refinement of progressive classification
+PROGRESSIVE_TILE_SIZE = 128
+
+# GeoTIFF export: tile size of the written COGs, in pixels
+EXPORT_BLOCK_SIZE = 256
+
 app = dash.Dash(
     __name__,
     suppress_callback_exceptions=True,
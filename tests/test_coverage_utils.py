@@ -0,0 +1,36 @@
+import io
+import numpy as np
+import pandas as pd
+import pytest
+from datashader.utils import lnglat_to_meters
+from PIL import Image
+from utils import coverage_utils
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    # A single 0.1 degree footprint, far narrower than a pixel at low zoom
+    x, y = lnglat_to_meters(np.array([-95.05, -94.95]), np.array([38, 38.1]))
+    df = pd.DataFrame({"x0": [x[0]], "x1": [x[1]], "y0": [y[0]], "y1": [y[1]]})
+    monkeypatch.setattr(coverage_utils, "footprints", lambda: df)
+    monkeypatch.setattr(coverage_utils, "_cache_key", lambda *parts: "")
+    monkeypatch.setattr(coverage_utils, "load_value", lambda key: None)
+    monkeypatch.setattr(coverage_utils, "save_value", lambda *args: None)
+
+
+def _covered(tile):
+    return (np.asarray(Image.open(io.BytesIO(tile)))[..., 3] > 0).sum()
+
+
+@pytest.mark.parametrize("z, x, y", [(0, 0, 0), (1, 0, 0), (2, 0, 1)])
+def test_footprints_narrower_than_a_pixel_are_drawn(catalog, z, x, y):
+    assert _covered(coverage_utils.render_tile(z, x, y)) > 0
+
+
+def test_footprints_are_filled(catalog):
+    # At zoom 12 the footprint spans a few hundred pixels each way
+    assert _covered(coverage_utils.render_tile(12, 967, 1579)) > 10000
+
+
+def test_tiles_without_footprints_are_empty(catalog):
+    assert coverage_utils.render_tile(2, 3, 3) == coverage_utils.EMPTY_TILE
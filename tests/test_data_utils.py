@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from utils.data_utils import class_statistics, pixel_areas
+
+
+def test_pixel_areas_add_up_to_the_footprint():
+    # 0.1 degree at 38°N
+    areas = pixel_areas((100, 50), 38, 0.1)
+    assert areas.shape == (100,)
+    assert areas.sum() * 50 == pytest.approx(97.4, abs=0.05)
+    # Rows run from north to south, where pixels are larger
+    assert np.all(np.diff(areas) > 0)
+
+
+def test_pixel_areas_at_the_equator():
+    areas = pixel_areas((10, 10), 0, 1)
+    assert areas.sum() * 10 == pytest.approx(12363.9, rel=1e-4)
+    np.testing.assert_allclose(areas, areas[::-1])
+
+
+def test_class_statistics():
+    segmentation = np.zeros((100, 50), dtype=np.int32)
+    segmentation[50:] = 1
+    img = np.zeros((100, 50, 3), dtype=np.uint8)
+    img[50:] = [10, 20, 30]
+    stats = class_statistics(segmentation, img, 3, 38, 0.1)
+    assert stats["pixels"] == [2500, 2500, 0]
+    assert stats["total_area_km2"] == pytest.approx(97.4, abs=0.05)
+    north, south, empty = stats["area_km2"]
+    assert north < south
+    assert north + south == pytest.approx(stats["total_area_km2"])
+    assert empty == 0
+    assert stats["band_means"] == [[0, 0, 0], [10, 20, 30], [0, 0, 0]]
@@ -0,0 +1,59 @@
+import pstats
+import threading
+from utils import profiling_utils
+from utils.scheduler import FairScheduler
+
+
+def _job(x):
+    return x * 2
+
+
+def _caller(sampled, recorded=False):
+    return {
+        "sampled": sampled,
+        "stages": {},
+        "profilers": [],
+        "recorded": recorded,
+        "lock": threading.Lock(),
+    }
+
+
+def _timed_job():
+    with profiling_utils.stage("job"):
+        return 1
+
+
+def test_jobs_of_sampled_calls_are_profiled():
+    caller = _caller(sampled=True)
+    token = profiling_utils._caller.set(caller)
+    try:
+        assert FairScheduler(1).submit(_job, 2, tenant="t").result() == 4
+    finally:
+        profiling_utils._caller.reset(token)
+    assert len(caller["profilers"]) == 1
+    functions = pstats.Stats(caller["profilers"][0]).stats
+    assert any(name == "_job" for _, _, name in functions)
+
+
+def test_jobs_are_not_profiled_by_default():
+    assert profiling_utils.run_profiled(_job, 2) == 4
+    assert profiling_utils._caller.get() is None
+
+
+def test_jobs_outliving_the_call_are_recorded_on_their_own(monkeypatch):
+    records = []
+    monkeypatch.setattr(profiling_utils, "SLOW_CALLBACK_SEC", -1)
+    monkeypatch.setattr(
+        profiling_utils, "_record", lambda *call: records.append(call)
+    )
+    caller = _caller(sampled=False, recorded=True)
+    token = profiling_utils._caller.set(caller)
+    try:
+        assert profiling_utils.run_profiled(_timed_job) == 1
+    finally:
+        profiling_utils._caller.reset(token)
+    assert caller["stages"] == {}
+    [(name, _, _, stages, profilers)] = records
+    assert name == "_timed_job"
+    assert list(stages) == ["job"]
+    assert profilers == []
@@ -0,0 +1,37 @@
+import json
+import numpy as np
+from utils import progressive_utils
+
+
+def test_batch_renews_its_slot_per_image(monkeypatch):
+    saved, calls = {}, []
+    arrays = {"a": np.zeros((2, 2, 3)), "b": np.zeros((2, 2, 3)), "c": None}
+    monkeypatch.setattr(
+        progressive_utils, "load_preprocessed", lambda i, e: arrays[i]
+    )
+    monkeypatch.setattr(
+        progressive_utils,
+        "classify_images",
+        lambda images, n: enumerate(np.zeros((2, 2)) for _ in images),
+    )
+    monkeypatch.setattr(
+        progressive_utils, "save_classification", lambda *args: True
+    )
+    monkeypatch.setattr(
+        progressive_utils,
+        "save_value",
+        lambda key, value, ttl: saved.update({key: json.loads(value)}),
+    )
+    for name in ["renew_job_slot", "release_job_slot"]:
+        monkeypatch.setattr(
+            progressive_utils, name, lambda slot, name=name: calls.append(name)
+        )
+
+    progressive_utils._classify_batch(
+        "job", ["a", "b", "c"], "k-means", 3, "none", ("t", "lease")
+    )
+    assert calls == ["renew_job_slot"] * 3 + ["release_job_slot"]
+    (progress,) = saved.values()
+    assert progress["classified"] == 2
+    assert progress["missing"] == ["c"]
+    assert progress["finished"]
@@ -0,0 +1,61 @@
+import time
+import pytest
+import redis
+from utils import rate_limit
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")  # fakeredis runs Lua scripts with lupa
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(rate_limit, "redis_instance", client)
+    for script in [rate_limit._ACQUIRE, rate_limit._OBSERVE]:
+        monkeypatch.setattr(script, "registered_client", client)
+    return client
+
+
+def test_interactive_is_granted(client):
+    assert rate_limit.acquire("interactive", timeout=1) < 1
+    stats = rate_limit.limiter_stats()
+    assert stats["interactive"]["requests"] == 1
+    assert stats["interactive"]["queue_depth"] == 0
+
+
+def test_batch_defers_to_waiting_interactive(client):
+    waiting = rate_limit._waiting("interactive")
+    client.zadd(waiting, {"other": time.time() + 60})
+    with pytest.raises(rate_limit.RateLimitTimeout):
+        rate_limit.acquire("batch", timeout=0.3)
+    assert rate_limit.limiter_stats()["interactive"]["queue_depth"] == 1
+    assert client.zcard(rate_limit._waiting("batch")) == 0
+
+
+def test_expired_waiters_are_ignored(client):
+    waiting = rate_limit._waiting("interactive")
+    client.zadd(waiting, {"killed": time.time() - 1})
+    assert rate_limit.acquire("batch", timeout=1) < 1
+    assert client.zcard(waiting) == 0
+
+
+def test_batch_keeps_the_reserve(client, monkeypatch):
+    reserve = rate_limit.NASA_BATCH_RESERVE
+    client.hset(
+        rate_limit.BUCKET, mapping={"tokens": reserve, "updated": time.time()}
+    )
+    monkeypatch.setattr(rate_limit, "NASA_RATE_LIMIT_PER_HOUR", 1)
+    with pytest.raises(rate_limit.RateLimitTimeout):
+        rate_limit.acquire("batch", timeout=0.3)
+    assert rate_limit.acquire("interactive", timeout=1) < 1
+
+
+@pytest.mark.parametrize(
+    "error", [redis.exceptions.ConnectionError, redis.exceptions.TimeoutError]
+)
+def test_fails_open_when_redis_is_unavailable(client, monkeypatch, error):
+    def unavailable(*args, **kwargs):
+        raise error("unavailable")
+
+    monkeypatch.setattr(client, "zadd", unavailable)
+    assert rate_limit.acquire("interactive", timeout=1) < 1
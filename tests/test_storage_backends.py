@@ -0,0 +1,133 @@
+import time
+import numpy as np
+import pytest
+from utils.storage_backends import DiskBackend, RedisBackend, StorageBackend
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture(params=["redis", "disk"])
+def backend(request, tmp_path):
+    if request.param == "redis":
+        return RedisBackend(client=fakeredis.FakeStrictRedis(), replicas=[])
+    return DiskBackend(root=str(tmp_path))
+
+
+def test_get_missing(backend):
+    assert backend.get("missing") is None
+    assert backend.get_array("missing") is None
+    assert not backend.exists("missing")
+
+
+def test_set_many_and_get(backend):
+    backend.set_many({"a": b"1", "b": b"2"})
+    assert backend.get("a") == b"1"
+    assert backend.get("b") == b"2"
+    assert backend.exists_many(["a", "missing", "b"]) == [True, False, True]
+
+
+def test_overwrite(backend):
+    backend.set_many({"a": b"1"})
+    backend.set_many({"a": b"2"})
+    assert backend.get("a") == b"2"
+
+
+@pytest.mark.parametrize("dtype", ["uint8", "int32", "float32"])
+def test_array_round_trip(backend, dtype):
+    array = np.arange(2 * 3 * 4, dtype=dtype).reshape((2, 3, 4))
+    backend.set_many({"img": array})
+    loaded = backend.get_array("img")
+    assert loaded.dtype == array.dtype
+    assert loaded.shape == array.shape
+    np.testing.assert_array_equal(loaded, array)
+
+
+def test_array_is_a_snapshot(backend):
+    array = np.zeros((4, 4), dtype=np.uint8)
+    backend.set_many({"img": array})
+    array[:] = 1
+    assert backend.get_array("img").sum() == 0
+
+
+def test_array_overwrite(backend):
+    backend.set_many({"img": np.zeros((4, 4), dtype=np.uint8)})
+    backend.set_many({"img": np.ones((2, 2), dtype=np.uint8)})
+    np.testing.assert_array_equal(
+        backend.get_array("img"), np.ones((2, 2), dtype=np.uint8)
+    )
+
+
+def test_disk_arrays_are_read_only_memory_maps(tmp_path):
+    backend = DiskBackend(root=str(tmp_path))
+    backend.set_many({"img": np.zeros((4, 4), dtype=np.uint8)})
+    loaded = backend.get_array("img")
+    assert isinstance(loaded, np.memmap)
+    assert not loaded.flags.writeable
+    with pytest.raises(ValueError):
+        loaded[0, 0] = 1
+
+
+def test_delete(backend):
+    backend.set_many({"a": b"1", "img": np.zeros(3)})
+    backend.delete(["a", "img", "missing"])
+    assert backend.get("a") is None
+    assert backend.get_array("img") is None
+    backend.delete([])
+
+
+def test_ttl_expiry(backend):
+    backend.set_many({"short": b"1", "img": np.zeros(3)}, ttl=1)
+    backend.set_many({"long": b"2"}, ttl=60)
+    assert backend.get("short") == b"1"
+    time.sleep(1.1)
+    assert backend.get("short") is None
+    assert backend.get_array("img") is None
+    assert not backend.exists("short")
+    assert backend.scan("*") == ["long"]
+    assert backend.get("long") == b"2"
+
+
+def test_expire_refreshes_ttl(backend):
+    backend.set_many({"a": b"1", "b": b"2"}, ttl=1)
+    backend.expire(["a", "missing"], 60)
+    time.sleep(1.1)
+    assert backend.get("a") == b"1"
+    assert backend.get("b") is None
+
+
+def test_scan(backend):
+    backend.set_many(
+        {"{t:a}_metadata": b"", "{t:b}_metadata": b"", "{t:a}": b""}
+    )
+    assert sorted(backend.scan("{t:*}_metadata")) == [
+        "{t:a}_metadata",
+        "{t:b}_metadata",
+    ]
+    assert backend.scan("other_*") == []
+
+
+def test_hashes(backend):
+    assert backend.hgetall("h") == {}
+    backend.hset("h", {"a": 1, "b": "x"})
+    backend.hset("h", {})
+    assert backend.hgetall("h") == {"a": "1", "b": "x"}
+    assert backend.hmget("h", ["b", "missing", "a"]) == ["x", None, "1"]
+    backend.hdel("h", ["b", "missing"])
+    backend.hdel("h", [])
+    assert backend.hgetall("h") == {"a": "1"}
+
+
+def test_hincrby(backend):
+    assert backend.hincrby("h", "n") == 1
+    assert backend.hincrby("h", "n", 5) == 6
+    assert backend.hincrby("h", "n", -6) == 0
+    assert backend.hgetall("h") == {"n": "0"}
+
+
+def test_incomplete_backends_cannot_be_created():
+    class Incomplete(StorageBackend):
+        def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        Incomplete()
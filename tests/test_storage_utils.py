@@ -0,0 +1,124 @@
+import types
+import numpy as np
+import pytest
+from utils import storage_utils, tenant_utils
+from utils.storage_backends import DiskBackend, RedisBackend
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture(params=["redis", "disk"])
+def backend(request, tmp_path, monkeypatch):
+    if request.param == "redis":
+        backend = RedisBackend(client=fakeredis.FakeStrictRedis(), replicas=[])
+    else:
+        backend = DiskBackend(root=str(tmp_path))
+    monkeypatch.setattr(storage_utils, "backend", backend)
+    monkeypatch.setattr(storage_utils, "STORAGE_BUDGET_BYTES", 0)
+    monkeypatch.setattr(storage_utils, "TENANT_QUOTA_BYTES", 0)
+    monkeypatch.setattr(storage_utils, "_last_prune", 0)
+    # Every access is one second after the previous one
+    clock = iter(range(1000, 2000))
+    monkeypatch.setattr(
+        storage_utils, "time", types.SimpleNamespace(time=lambda: next(clock))
+    )
+    return backend
+
+
+@pytest.fixture
+def tenant():
+    def as_tenant(name):
+        return tenant_utils._tenant.set(name)
+
+    token = as_tenant("a")
+    yield as_tenant
+    tenant_utils._tenant.reset(token)
+
+
+def _save(img_id, size):
+    return storage_utils.save_image_data(
+        img_id,
+        {img_id: np.zeros(size, np.uint8), f"{img_id}_metadata": b"m"},
+    )
+
+
+def _image_bytes(backend):
+    sizes = backend.hgetall(storage_utils.IMAGE_BYTES)
+    return {k: int(v) for k, v in sizes.items()}
+
+
+def test_overwrite_accounts_for_the_size_change(backend, tenant):
+    _save("img", 100)
+    assert _image_bytes(backend) == {"{a:img}": 101}
+    storage_utils.save_image_data("img", {"img": np.zeros(10, np.uint8)})
+    assert _image_bytes(backend) == {"{a:img}": 11}
+    storage_utils.save_image_data("img", {"img_thumb": b"1234"})
+    assert _image_bytes(backend) == {"{a:img}": 15}
+
+
+def test_catalog_version_bumps_on_add_and_delete(backend, tenant):
+    assert storage_utils.catalog_version() == 0
+    _save("img", 10)
+    assert storage_utils.catalog_version() == 1
+    _save("img", 20)
+    storage_utils.save_image_data("img", {"img_thumb": b""})
+    assert storage_utils.catalog_version() == 1
+    storage_utils.delete_image("img")
+    assert storage_utils.catalog_version() == 2
+    tenant("b")
+    assert storage_utils.catalog_version() == 0
+
+
+def test_tenant_quota_only_evicts_the_tenants_images(
+    backend, tenant, monkeypatch
+):
+    monkeypatch.setattr(storage_utils, "TENANT_QUOTA_BYTES", 250)
+    tenant("b")
+    _save("other", 200)
+    tenant("a")
+    _save("old", 100)
+    _save("new", 100)
+    assert _save("newest", 100) == ["{a:old}"]
+    assert set(_image_bytes(backend)) == {"{a:new}", "{a:newest}", "{b:other}"}
+    assert sorted(storage_utils.list_images()) == ["new", "newest"]
+
+
+def test_budget_evicts_the_least_recently_used(backend, tenant, monkeypatch):
+    monkeypatch.setattr(storage_utils, "STORAGE_BUDGET_BYTES", 250)
+    _save("old", 100)
+    tenant("b")
+    _save("recent", 100)
+    tenant("a")
+    storage_utils.touch_image("old")
+    tenant("b")
+    assert _save("new", 100) == ["{b:recent}"]
+    assert set(_image_bytes(backend)) == {"{a:old}", "{b:new}"}
+
+
+def test_written_image_is_protected(backend, tenant, monkeypatch):
+    monkeypatch.setattr(storage_utils, "STORAGE_BUDGET_BYTES", 50)
+    monkeypatch.setattr(storage_utils, "TENANT_QUOTA_BYTES", 50)
+    assert _save("img", 100) == []
+    assert storage_utils.exists("img_metadata")
+    assert storage_utils.enforce_budget() == ["{a:img}"]
+
+
+def test_expired_images_are_pruned_periodically(backend, tenant):
+    _save("img", 10)
+    backend.delete(["{a:img}_metadata"])
+    storage_utils._prune_expired(interval=0)
+    assert _image_bytes(backend) == {}
+    assert storage_utils.catalog_version() == 2
+
+
+def test_writes_do_not_prune_every_time(backend, tenant, monkeypatch):
+    calls = []
+    exists_many = backend.exists_many
+    monkeypatch.setattr(
+        backend,
+        "exists_many",
+        lambda keys: calls.append(keys) or exists_many(keys),
+    )
+    for i in range(5):
+        _save(f"img{i}", 10)
+    assert len(calls) == 1
@@ -0,0 +1,46 @@
+import pytest
+from utils import tenant_utils
+from utils.storage_backends import DiskBackend
+
+
+@pytest.fixture(autouse=True)
+def backend(monkeypatch, tmp_path):
+    backend = DiskBackend(root=str(tmp_path))
+    monkeypatch.setattr(tenant_utils, "backend", backend)
+    monkeypatch.setattr(tenant_utils, "TENANT_MAX_JOBS", 2)
+    return backend
+
+
+def test_namespace_hides_the_identity():
+    cookie = "0" * 32
+    namespace = tenant_utils.tenant_namespace(cookie)
+    assert tenant_utils._TENANT_ID.match(namespace)
+    assert namespace != cookie
+    assert namespace == tenant_utils.tenant_namespace(cookie)
+
+
+def test_slots_are_limited_per_tenant():
+    slots = [tenant_utils.acquire_job_slot("t") for _ in range(2)]
+    with pytest.raises(tenant_utils.TenantQuotaExceeded):
+        tenant_utils.acquire_job_slot("t")
+    tenant_utils.acquire_job_slot("other")
+    tenant_utils.release_job_slot(slots[0])
+    tenant_utils.acquire_job_slot("t")
+
+
+def test_expired_leases_free_their_slots(monkeypatch):
+    # Jobs killed without releasing their slots
+    monkeypatch.setattr(tenant_utils, "TENANT_JOB_LEASE_SEC", -1)
+    for _ in range(2):
+        tenant_utils.acquire_job_slot("t")
+    monkeypatch.setattr(tenant_utils, "TENANT_JOB_LEASE_SEC", 60)
+    for _ in range(2):
+        tenant_utils.acquire_job_slot("t")
+    with pytest.raises(tenant_utils.TenantQuotaExceeded):
+        tenant_utils.acquire_job_slot("t")
+
+
+def test_job_slot_is_released(backend):
+    with tenant_utils.job_slot("t"):
+        assert len(backend.hgetall(tenant_utils._jobs_key("t"))) == 1
+    assert backend.hgetall(tenant_utils._jobs_key("t")) == {}
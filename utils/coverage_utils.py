@@ -0,0 +1,171 @@
+import io, math, pickle
+import datashader as ds
+import datashader.transfer_functions as tf
+import numpy as np
+import pandas as pd
+from datashader.utils import lnglat_to_meters
+from PIL import Image
+from constants import (
+    COVERAGE_CMAP,
+    COVERAGE_MAX_COUNT,
+    COVERAGE_TILE_SEC,
+    COVERAGE_TILE_SIZE,
+)
+from utils.storage_utils import (
+    catalog_version,
+    list_images,
+    load,
+    load_value,
+    save_value,
+)
+from utils.tenant_utils import current_tenant
+
+# Half the width of the Web Mercator world, in meters
+ORIGIN_SHIFT = math.pi * 6378137
+
+
+def tile_bounds(z, x, y):
+    """
+    Computes the Web Mercator bounds of an XYZ map tile.
+
+    Args:
+        z (int): The zoom level.
+        x (int): The column of the tile, from the west.
+        y (int): The row of the tile, from the north.
+
+    Returns:
+        tuple[float, float, float, float]: The (west, south, east, north) bounds in meters.
+
+    """
+    size = 2 * ORIGIN_SHIFT / 2 ** z
+    west = -ORIGIN_SHIFT + x * size
+    north = ORIGIN_SHIFT - y * size
+    return west, north - size, west + size, north
+
+
+def _cache_key(*parts):
+    # Versioned, so a catalog change makes every cached entry unreachable
+    return "_".join(
+        [
+            "coverage",
+            current_tenant(),
+            str(catalog_version()),
+            *map(str, parts),
+        ]
+    )
+
+
+def footprints():
+    """
+    Returns the footprints of the current tenant's images in Web Mercator.
+
+    Returns:
+        pd.DataFrame: One row per image, with columns x0, x1, y0 and y1 in meters.
+
+    """
+    key = _cache_key("footprints")
+    cached = load_value(key)
+    if cached is not None:
+        return pd.read_json(io.BytesIO(cached), orient="split")
+
+    rows = []
+    for img_id in list_images():
+        img_info = load(f"{img_id}_metadata", touch=False)
+        if img_info is None:
+            continue
+        img_info = pickle.loads(img_info)
+        lat, lon = float(img_info["lat"]), float(img_info["lon"])
+        half = float(img_info["dim"]) / 2
+        x, y = lnglat_to_meters(
+            np.array([lon - half, lon + half]),
+            np.array([lat - half, lat + half]),
+        )
+        rows.append([x[0], x[1], y[0], y[1]])
+    df = pd.DataFrame(rows, columns=["x0", "x1", "y0", "y1"], dtype=float)
+    save_value(key, df.to_json(orient="split"), COVERAGE_TILE_SEC)
+    return df
+
+
+def _empty_tile():
+    buffer = io.BytesIO()
+    size = (COVERAGE_TILE_SIZE, COVERAGE_TILE_SIZE)
+    Image.new("RGBA", size).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+EMPTY_TILE = _empty_tile()
+
+
+def render_tile(z, x, y):
+    """
+    Renders the coverage of the current tenant's catalog into a map tile.
+
+    Each pixel is colored by the number of image footprints covering it,
+    footprints narrower than a pixel counting toward the one at their center.
+    Tiles are cached until the catalog changes, and tiles without any
+    footprint are not rendered at all.
+
+    Args:
+        z (int): The zoom level.
+        x (int): The column of the tile, from the west.
+        y (int): The row of the tile, from the north.
+
+    Returns:
+        bytes: The tile as a transparent PNG.
+
+    """
+    key = _cache_key(z, x, y)
+    cached = load_value(key)
+    if cached is not None:
+        return cached
+
+    west, south, east, north = tile_bounds(z, x, y)
+    df = footprints()
+    df = df[
+        (df.x1 >= west) & (df.x0 <= east) & (df.y1 >= south) & (df.y0 <= north)
+    ]
+    if df.empty:
+        tile = EMPTY_TILE
+    else:
+        canvas = ds.Canvas(
+            plot_width=COVERAGE_TILE_SIZE,
+            plot_height=COVERAGE_TILE_SIZE,
+            x_range=(west, east),
+            y_range=(south, north),
+        )
+        # Areas only fill the pixels whose center they cover, so footprints
+        # narrower than a pixel are drawn as a point at their center instead
+        pixel = (east - west) / COVERAGE_TILE_SIZE
+        small = (df.x1 - df.x0 < pixel) | (df.y1 - df.y0 < pixel)
+        agg = canvas.points(
+            pd.DataFrame(
+                {
+                    "x": (df.x0[small] + df.x1[small]) / 2,
+                    "y": (df.y0[small] + df.y1[small]) / 2,
+                }
+            ),
+            "x",
+            "y",
+            agg=ds.count(),
+        )
+        if not small.all():
+            # Each row fills the band between y0 and y1 over [x0, x1]
+            agg = agg + canvas.area(
+                df[~small],
+                x=["x0", "x1"],
+                y=["y0", "y0"],
+                y_stack=["y1", "y1"],
+                axis=1,
+                agg=ds.count(),
+            )
+        img = tf.shade(
+            agg,
+            cmap=COVERAGE_CMAP,
+            how="linear",
+            span=[1, COVERAGE_MAX_COUNT],
+            min_alpha=120,
+        )
+        # Single pixels would be hard to spot on the map
+        tile = tf.spread(img, px=1).to_bytesio().getvalue()
+    save_value(key, tile, COVERAGE_TILE_SEC)
+    return tile
@@ -1,33 +1,136 @@
-import requests, PIL, io, json, pickle  # , cv2
-from constants import redis_instance, REDIS_EXPIRE_SEC, NASA_KEY
+import PIL, io, json, multiprocessing, os, pickle, threading, time
+import cv2
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from constants import (
+    CLAHE_CLIP_LIMIT,
+    CLAHE_TILE_GRID,
+    ENHANCE_GAMMA,
+    STRETCH_PERCENTILES,
+    NASA_KEY,
+    CLASSIFY_WORKERS,
+    CLASSIFY_SAMPLE_PIXELS,
+    CLASSIFY_SIZE,
+    THUMBNAIL_SIZE,
+    ASSET_CACHE_SEC,
+)
 import pandas as pd
 import dash_leaflet.express as dlx
 from sklearn import cluster
 import numpy as np
 from PIL import Image
 import plotly.express as px
+from utils.profiling_utils import stage
+from utils.rate_limit import nasa_get, RateLimitTimeout
+from utils.storage_backends import backend
+from utils.storage_utils import (
+    delete_value,
+    exists,
+    list_images,
+    load,
+    load_array,
+    load_value,
+    save_image_data,
+    save_value,
+    touch_image,
+)
+
+PREFETCH_STATS = "prefetch_stats"
+# Cache key -> expiry of the prefetched entries not used yet
+PREFETCH_PENDING = "prefetch_pending"
+EARTH_RADIUS_KM = 6371.0088
+
+
+def asset_cache_key(lat, lon, dim, date):
+    return f"assets_{float(lat):.4f}_{float(lon):.4f}_{float(dim):.4f}_{date}"
+
+
+def get_asset_metadata(lat, lon, dim, date, priority="interactive"):
+    """
+    Retrieves the asset metadata of a location, going through the cache.
 
+    Successful responses are cached for ``ASSET_CACHE_SEC``. A cache hit on
+    an entry stored by a prefetch is counted as a prefetch hit.
+
+    Args:
+        lat (float): Latitude of the image center.
+        lon (float): Longitude of the image center.
+        dim (float): Width and height of the image in degrees.
+        date (str): Date of the image.
+        priority (str): Rate limiter priority of the API call on a cache miss.
+
+    Returns:
+        dict: The asset metadata, or the error returned by the API.
+
+    Raises:
+        RateLimitTimeout: If the API call could not be made within the quota.
+
+    """
+    key = asset_cache_key(lat, lon, dim, date)
+    cached = load_value(key)
+    if cached is not None:
+        entry = json.loads(cached)
+        if entry["prefetched"] and priority == "interactive":
+            record_prefetch("hits")
+            backend.hdel(PREFETCH_PENDING, [key])
+            save_value(
+                key,
+                json.dumps({**entry, "prefetched": False}),
+                ASSET_CACHE_SEC,
+            )
+        return entry["metadata"]
 
-def get_image(lat, lon, dim, name, date="2014-02-04"):
-    img_url = f"https://api.nasa.gov/planetary/earth/imagery?lon={lon}&lat={lat}&date={date}&dim={dim}&api_key={NASA_KEY}"
     asset_url = f"https://api.nasa.gov/planetary/earth/assets?lon={lon}&lat={lat}&date={date}&dim={dim}&api_key={NASA_KEY}"
-    img_metadata = json.loads(requests.get(asset_url).content)
+    img_metadata = json.loads(nasa_get(asset_url, priority).content)
+    if "id" in img_metadata:
+        entry = {"metadata": img_metadata, "prefetched": priority == "batch"}
+        save_value(key, json.dumps(entry), ASSET_CACHE_SEC)
+        if entry["prefetched"]:
+            backend.hset(
+                PREFETCH_PENDING, {key: time.time() + ASSET_CACHE_SEC}
+            )
+    return img_metadata
+
+
+def record_prefetch(event):
+    """Counts a prefetch event: "requests", "hits", "image_requests" or "image_hits"."""
+    backend.hincrby(PREFETCH_STATS, event, 1)
+
+
+def get_image(lat, lon, dim, name, date="2014-02-04", priority="interactive"):
+    img_url = f"https://api.nasa.gov/planetary/earth/imagery?lon={lon}&lat={lat}&date={date}&dim={dim}&api_key={NASA_KEY}"
+    try:
+        with stage("asset_metadata"):
+            img_metadata = get_asset_metadata(lat, lon, dim, date, priority)
+    except RateLimitTimeout:
+        return "NASA API quota exhausted. Please try again shortly."
 
     if any(key in img_metadata for key in ["msg", "error"]):
         msg = img_metadata["msg"]
-        print(asset_url)
+        print(f"Error retrieving asset metadata: {msg}")
         return f"Error retrieving data: {msg}"
     elif "id" in img_metadata.keys():
         img_id = img_metadata["id"]
-        if img_id in [x.decode("utf8") for x in redis_instance.keys()]:
-            img = pickle.loads(redis_instance.get(img_id))
-            return "Image already stored in redis. Loading from cache."
+        if exists(f"{img_id}_metadata"):
+            touch_image(img_id)
+            return "Image already stored. Loading from cache."
         else:
-            print("Retrieving image data from API...")
-            img_data = requests.get(img_url).content
+            img_data = load_value(f"prefetch_img_{img_id}")
+            if img_data is not None:
+                record_prefetch("image_hits")
+                delete_value(f"prefetch_img_{img_id}")
+            else:
+                print("Retrieving image data from API...")
+                try:
+                    with stage("download"):
+                        img_data = nasa_get(img_url, priority).content
+                except RateLimitTimeout:
+                    return (
+                        "NASA API quota exhausted. Please try again shortly."
+                    )
             image_bytes = io.BytesIO(img_data)
-            img = PIL.Image.open(image_bytes)
-            # img = enhance_image(img)
+            img = PIL.Image.open(image_bytes).convert("RGB")
             img_info = {
                 "name": name,
                 "lat": lat,
@@ -37,13 +140,97 @@ def get_image(lat, lon, dim, name, date="2014-02-04"):
                 "id": img_id,
             }
 
-            redis_instance.set(img_id, pickle.dumps(img))
-            redis_instance.set(f"{img_id}_metadata", pickle.dumps(img_info))
-            redis_instance.expire(img_id, REDIS_EXPIRE_SEC)
-            redis_instance.expire(f"{img_id}_metadata", REDIS_EXPIRE_SEC)
+            with stage("ingest"):
+                values = ingest_image(img_id, img)
+            with stage("store"):
+                save_image_data(
+                    img_id,
+                    {f"{img_id}_metadata": pickle.dumps(img_info), **values},
+                )
             return f"{img_id} successfully retrieved and stored in database."
 
 
+def ingest_image(img_id, img):
+    """
+    Precomputes everything later requests need from a newly downloaded image.
+
+    Args:
+        img_id (str): The id of the image.
+        img (PIL.Image.Image): The downloaded RGB image.
+
+    Returns:
+        dict[str, bytes | np.ndarray]: The full image, its classification-sized and
+            thumbnail versions, and per-band statistics, keyed by storage key.
+
+    """
+    img_array = np.asarray(img)
+    thumbnail = img.copy()
+    thumbnail.thumbnail(THUMBNAIL_SIZE)
+    return {
+        img_id: img_array,
+        f"{img_id}_resized": np.asarray(img.resize(CLASSIFY_SIZE)),
+        f"{img_id}_thumb": np.asarray(thumbnail),
+        f"{img_id}_stats": json.dumps(band_statistics(img_array)).encode(),
+    }
+
+
+def band_statistics(img_array):
+    """
+    Computes summary statistics and a histogram of each band of a uint8 image.
+
+    Args:
+        img_array (np.ndarray): A 3D uint8 NumPy array representing the image.
+
+    Returns:
+        list[dict]: For each band, its min, max, mean, standard deviation and 256-bin histogram.
+
+    """
+    stats = []
+    for band in np.moveaxis(img_array, -1, 0):
+        histogram = np.bincount(band.ravel(), minlength=256)
+        values = np.arange(256)
+        mean = (histogram * values).sum() / band.size
+        std = np.sqrt((histogram * (values - mean) ** 2).sum() / band.size)
+        nonzero = np.flatnonzero(histogram)
+        stats.append(
+            {
+                "min": int(nonzero[0]),
+                "max": int(nonzero[-1]),
+                "mean": float(mean),
+                "std": float(std),
+                "histogram": histogram.tolist(),
+            }
+        )
+    return stats
+
+
+def load_preprocessed(img_id, enhancement="none"):
+    """
+    Loads an image ready for classification.
+
+    Starts from the array resized at ingest time, falling back to resizing the
+    full image for images stored before it existed.
+
+    Args:
+        img_id (str): The id of the stored image.
+        enhancement (str): The contrast enhancement to apply, one of the ``ENHANCEMENTS``.
+
+    Returns:
+        np.ndarray | None: A 3D NumPy array representing the preprocessed image,
+            or None if the image expired or was evicted.
+
+    """
+    if enhancement != "none":
+        img_array = load_enhanced(img_id, enhancement)
+    else:
+        img_array = load_array(f"{img_id}_resized", replica=True)
+        if img_array is None:
+            img_array = load_array(img_id, replica=True)
+    if img_array is None:
+        return None
+    return process_img(img_array, CLASSIFY_SIZE)
+
+
 def update_df(df=None):
     df = (
         pd.DataFrame(
@@ -62,10 +249,10 @@ def update_df(df=None):
         if not df
         else df
     )
-    for key in redis_instance.keys("*_metadata"):
-        df = df.append(
-            pickle.loads(redis_instance.get(key)), ignore_index=True
-        )
+    for img_id in list_images():
+        img_info = load(f"{img_id}_metadata", touch=False)
+        if img_info is not None:
+            df = df.append(pickle.loads(img_info), ignore_index=True)
     return df
 
 
@@ -75,48 +262,292 @@ def to_geojson(df):
     )
 
 
-def kmeans_cluster(img_array, n_clusters):
+def fit_kmeans_model(
+    img_arrays, n_clusters, sample_size=CLASSIFY_SAMPLE_PIXELS, seed=0
+):
     """
-    Performs k-means clustering on a single-band image.
+    Fits one k-means model on a pixel sample pooled across several images.
 
     Args:
-        img_array (np.ndarray): A 2D NumPy array representing the input single-band image.
+        img_arrays (list[np.ndarray]): 3D NumPy arrays of the images to pool pixels from.
         n_clusters (int): The number of clusters to use for the k-means algorithm.
+        sample_size (int): The total number of pixels to sample across all images.
+        seed (int): Seed for the pixel sampling.
+
+    Returns:
+        sklearn.cluster.KMeans: The fitted model, shared by every image in the batch.
+
+    """
+    rng = np.random.default_rng(seed)
+    per_image = max(sample_size // len(img_arrays), 1)
+    samples = []
+    for img_array in img_arrays:
+        X = img_array[:, :, 0].reshape((-1, 1))
+        if X.shape[0] > per_image:
+            X = X[rng.choice(X.shape[0], size=per_image, replace=False)]
+        samples.append(X)
+    k_means = cluster.KMeans(n_clusters=n_clusters, n_init=10)
+    k_means.fit(np.concatenate(samples))
+    return k_means
+
+
+def predict_segmentation(model, img_array):
+    """
+    Assigns every pixel of a single-band image to a cluster of a fitted model.
+
+    Args:
+        model (sklearn.cluster.KMeans): A fitted k-means model.
+        img_array (np.ndarray): A 3D NumPy array representing the input image.
 
     Returns:
         np.ndarray: A 2D NumPy array representing the clustering labels of the input image.
 
     """
-    img = img_array[:, :, 0]  # Just get one band of the image
-    X = img.reshape((-1, 1))
-    k_means = cluster.KMeans(n_clusters=n_clusters)
-    k_means.fit(X)
-    segmentation = k_means.labels_
-    segmentation = segmentation.reshape(img.shape)
+    img = img_array[:, :, 0]
+    return model.predict(img.reshape((-1, 1))).reshape(img.shape)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
 
-    return segmentation
+def _prediction_pool():
+    # One pool per gunicorn worker, created on first use so it is not
+    # inherited from the preloading master. Its processes are started by a
+    # fork server rather than forked from a worker whose other threads may
+    # hold locks
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            methods = multiprocessing.get_all_start_methods()
+            method = "forkserver" if "forkserver" in methods else "spawn"
+            _pool = ProcessPoolExecutor(
+                max_workers=CLASSIFY_WORKERS,
+                mp_context=multiprocessing.get_context(method),
+            )
+            _pool_pid = os.getpid()
+        return _pool
 
 
-def calculate_class_proportions(segmentation, n_clusters):
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+
+
+def classify_images(img_arrays, n_clusters):
     """
-    Calculates the proportion of pixels in each cluster in a clustering label image.
+    Classifies a batch of images with a single k-means model.
+
+    The model is fit once on a pooled pixel sample so classes are comparable
+    across images, then each image is predicted in the worker's process pool
+    of ``CLASSIFY_WORKERS`` processes, shared by all of its jobs.
 
     Args:
-        segmentation (np.ndarray): A 2D NumPy array representing the clustering labels of an image.
-        n_clusters (int): The number of clusters used to generate the clustering label image.
+        img_arrays (list[np.ndarray]): 3D NumPy arrays of the images to classify.
+        n_clusters (int): The number of clusters to use for the k-means algorithm.
+
+    Yields:
+        tuple[int, np.ndarray]: The index of each image and its clustering labels, in input order.
+
+    """
+    model = fit_kmeans_model(img_arrays, n_clusters)
+    predict = partial(predict_segmentation, model)
+    if CLASSIFY_WORKERS > 1 and len(img_arrays) > 1:
+        pool = _prediction_pool()
+        try:
+            yield from enumerate(pool.map(predict, img_arrays))
+        except BrokenProcessPool:
+            # A killed process breaks the pool for good, the next batch
+            # starts a new one
+            _discard_pool(pool)
+            raise
+    else:
+        yield from enumerate(map(predict, img_arrays))
+
+
+def save_classification(img_id, model, n_classes, segmentation):
+    """
+    Stores a classification result and updates the image metadata.
+
+    Per-class statistics are computed in the same pass and stored with the
+    result. All keys are written in a single pipelined round trip and
+    accounted against the storage budget.
+
+    Args:
+        img_id (str): The id of the classified image.
+        model (str): The name of the classification model.
+        n_classes (int): The number of classes used for the classification.
+        segmentation (np.ndarray): A 2D NumPy array representing the clustering labels of the image.
 
     Returns:
-        np.ndarray: A 1D NumPy array representing the proportion of pixels in each cluster.
+        bool: Whether the result was stored, False if the image expired or was evicted.
+
+    """
+    img_info = load(f"{img_id}_metadata")
+    if img_info is None:
+        return False
+    img_info = pickle.loads(img_info)
+    # The image the labels were predicted on, full size or resized
+    img_array = None
+    if segmentation.shape == CLASSIFY_SIZE[::-1]:
+        img_array = load_array(f"{img_id}_resized", touch=False)
+    if img_array is None:
+        img_array = load_array(img_id, touch=False)
+    if img_array is None:
+        return False
+    if img_array.shape[:2] != segmentation.shape:
+        height, width = segmentation.shape
+        img_array = np.asarray(
+            Image.fromarray(img_array).resize((width, height))
+        )
+    stats = class_statistics(
+        segmentation,
+        img_array,
+        n_classes,
+        float(img_info["lat"]),
+        float(img_info["dim"]),
+    )
+    class_proportions = np.round(
+        np.asarray(stats["pixels"]) / segmentation.size, 3
+    )
+    img_classified, class_colors = create_colored_mask_image(
+        segmentation, n_classes
+    )
+    img_info["classified"] = model
+    img_info["n classes"] = n_classes
+    img_info["class distribution"] = class_proportions
+
+    save_image_data(
+        img_id,
+        {
+            f"{img_id}_metadata": pickle.dumps(img_info),
+            f"{img_id}_classified": np.asarray(img_classified),
+            f"{img_id}_class_colors": json.dumps(class_colors).encode("utf8"),
+            f"{img_id}_class_stats": json.dumps(stats).encode("utf8"),
+        },
+    )
+    return True
+
 
+def pixel_areas(shape, lat, dim):
     """
-    total_pixels = segmentation.size
-    class_counts = np.zeros(n_clusters, dtype=int)
+    Computes the area covered by each row of pixels of an image.
 
-    for i in range(n_clusters):
-        class_counts[i] = np.sum(segmentation == i)
+    Pixels span equal angles, so their area shrinks with the cosine of the
+    latitude. Rows run from north to south.
+
+    Args:
+        shape (tuple[int, int]): The height and width of the image in pixels.
+        lat (float): Latitude of the image center.
+        dim (float): Width and height of the image in degrees.
+
+    Returns:
+        np.ndarray: The area of a pixel of each row, in km².
+
+    """
+    height, width = shape
+    edges = np.radians(np.linspace(lat + dim / 2, lat - dim / 2, height + 1))
+    rows = EARTH_RADIUS_KM ** 2 * np.radians(dim) * -np.diff(np.sin(edges))
+    return rows / width
 
-    class_proportions = class_counts / total_pixels
-    return np.round(class_proportions, 3)
+
+def class_statistics(segmentation, img_array, n_classes, lat, dim):
+    """
+    Computes the pixel count, area and mean band values of each class.
+
+    Args:
+        segmentation (np.ndarray): A 2D NumPy array of class labels.
+        img_array (np.ndarray): A 3D NumPy array of the classified image, the same size as ``segmentation``.
+        n_classes (int): The number of classes.
+        lat (float): Latitude of the image center.
+        dim (float): Width and height of the image in degrees.
+
+    Returns:
+        dict: The pixel count, area in km² and mean of each band of every
+            class, and the area of the whole image.
+
+    """
+    labels = segmentation.ravel()
+    pixels = np.bincount(labels, minlength=n_classes)
+    areas = pixel_areas(segmentation.shape, lat, dim)
+    area = np.bincount(
+        labels,
+        weights=np.broadcast_to(areas[:, None], segmentation.shape).ravel(),
+        minlength=n_classes,
+    )
+    means = [
+        np.bincount(labels, weights=band.ravel(), minlength=n_classes)
+        / np.maximum(pixels, 1)
+        for band in np.moveaxis(np.asarray(img_array), -1, 0)
+    ]
+    return {
+        "pixels": pixels.tolist(),
+        "area_km2": np.round(area, 4).tolist(),
+        "band_means": np.round(np.stack(means, axis=1), 2).tolist(),
+        "total_area_km2": round(float(area.sum()), 4),
+    }
+
+
+def load_class_stats(img_id):
+    """Returns the class statistics stored with a classification, or None."""
+    stats = load(f"{img_id}_class_stats", touch=False)
+    return json.loads(stats) if stats is not None else None
+
+
+def aggregate_class_stats(img_ids):
+    """
+    Sums the class areas and pixel counts of many classified images.
+
+    Classes are matched by index, which is only meaningful across images
+    classified together, as they share a model.
+
+    Args:
+        img_ids (list[str]): The ids of the images to aggregate.
+
+    Returns:
+        dict: The ids aggregated and skipped (unclassified), the total area
+            and the area and pixel count of each class.
+
+    """
+    area, pixels = np.zeros(0), np.zeros(0, dtype=np.int64)
+    images, skipped = [], []
+    for img_id in img_ids:
+        stats = load_class_stats(img_id)
+        if stats is None:
+            skipped.append(img_id)
+            continue
+        n = max(len(area), len(stats["pixels"]))
+        area = np.pad(area, (0, n - len(area)))
+        pixels = np.pad(pixels, (0, n - len(pixels)))
+        area[: len(stats["area_km2"])] += stats["area_km2"]
+        pixels[: len(stats["pixels"])] += stats["pixels"]
+        images.append(img_id)
+    return {
+        "images": images,
+        "skipped": skipped,
+        "total_area_km2": round(float(area.sum()), 4),
+        "classes": [
+            {"class": i, "area_km2": round(float(a), 4), "pixels": int(p)}
+            for i, (a, p) in enumerate(zip(area, pixels))
+        ],
+    }
+
+
+def images_in_bbox(west, south, east, north):
+    """Returns the ids of stored images whose center lies in a bounding box."""
+    img_ids = []
+    for img_id in list_images():
+        img_info = load(f"{img_id}_metadata", touch=False)
+        if img_info is None:
+            continue
+        img_info = pickle.loads(img_info)
+        lat, lon = float(img_info["lat"]), float(img_info["lon"])
+        if west <= lon <= east and south <= lat <= north:
+            img_ids.append(img_id)
+    return img_ids
 
 
 def create_colored_mask_image(segmentation, n_clusters):
@@ -174,46 +605,103 @@ def process_img(image, resize=(256, 256)):
     Preprocesses a PIL image for use in a machine learning model.
 
     Args:
-        image (PIL.Image.Image): The input image to preprocess.
+        image (PIL.Image.Image | np.ndarray): The input image to preprocess.
         resize (tuple[int, int]): The target size of the image after resizing. Defaults to (256, 256).
 
     Returns:
         np.ndarray: A 3D NumPy array representing the preprocessed image, with pixel values normalized to [0, 1].
 
     """
+    if isinstance(image, np.ndarray):
+        if image.shape[:2] == resize[::-1]:
+            # Already resized at ingest time, skip the decode and resample
+            return image.astype(np.float32) / 255
+        image = Image.fromarray(image)
     image = image.resize(resize)
     # Convert the image to a numpy array and normalize its values
     img_array = np.array(image).astype(np.float32) / 255
     return img_array
 
 
-# def enhance_image(image, clip_limit=3.1):
-#     """
-#     Enhances the contrast of a PIL image using the CLAHE algorithm.
+def _percentile(histogram, q):
+    # Smallest value with at least q percent of the pixels at or below it
+    cumulative = np.cumsum(histogram)
+    return int(np.searchsorted(cumulative, cumulative[-1] * q / 100))
 
-#     Args:
-#         image (PIL.Image.Image): The input RGB image to enhance.
-#         clip_limit (float, optional): The CLAHE clip limit. Defaults to 3.1.
 
-#     Returns:
-#         PIL.Image.Image: A new PIL image with enhanced contrast.
+def enhance_image(img_array, method, stats=None):
+    """
+    Enhances the contrast of a uint8 RGB image.
 
-#     """
-#     img_array = np.array(image)
+    CLAHE equalizes the lightness channel locally. The percentile stretch
+    maps the ``STRETCH_PERCENTILES`` of each band, read from the ingest-time
+    histograms in ``stats``, to the full range. Gamma applies
+    ``ENHANCE_GAMMA``. Stretch and gamma are a single lookup table pass.
 
-#     # Convert to LAB color space
-#     lab = cv2.cvtColor(img_array, cv2.COLOR_RGB2LAB)
+    Args:
+        img_array (np.ndarray): A 3D uint8 NumPy array representing the image.
+        method (str): One of the ``ENHANCEMENTS``.
+        stats (list[dict], optional): The band statistics of the full image,
+            from ``band_statistics``. Computed from ``img_array`` if missing.
 
-#     # Split into channels
-#     l, a, b = cv2.split(lab)
+    Returns:
+        np.ndarray: A new 3D uint8 NumPy array representing the enhanced image.
 
-#     # Apply histogram equalization to the L channel
-#     clahe = cv2.createCLAHE(clip_limit, tileGridSize=(10, 10))
-#     cl = clahe.apply(l)
+    """
+    img_array = np.ascontiguousarray(img_array, dtype=np.uint8)
+    if method == "clahe":
+        lab = cv2.cvtColor(img_array, cv2.COLOR_RGB2LAB)
+        clahe = cv2.createCLAHE(CLAHE_CLIP_LIMIT, CLAHE_TILE_GRID)
+        lightness = clahe.apply(cv2.extractChannel(lab, 0))
+        cv2.insertChannel(lightness, lab, 0)
+        return cv2.cvtColor(lab, cv2.COLOR_LAB2RGB, dst=lab)
+
+    values = np.arange(256, dtype=np.float32)
+    if method == "stretch":
+        stats = stats or band_statistics(img_array)
+        low, high = STRETCH_PERCENTILES
+        lut = np.empty((256, 1, 3), dtype=np.uint8)
+        for i, band in enumerate(stats):
+            lo = _percentile(band["histogram"], low)
+            hi = max(_percentile(band["histogram"], high), lo + 1)
+            lut[:, 0, i] = np.clip((values - lo) * 255 / (hi - lo), 0, 255)
+    elif method == "gamma":
+        lut = np.round((values / 255) ** ENHANCE_GAMMA * 255).astype(np.uint8)
+    else:
+        raise ValueError(f"Unknown enhancement: {method}")
+    return cv2.LUT(img_array, lut)
+
+
+def load_enhanced(img_id, method, resized=True):
+    """
+    Loads an enhanced variant of a stored image, computing and storing it once.
+
+    Args:
+        img_id (str): The id of the stored image.
+        method (str): One of the ``ENHANCEMENTS`` other than "none".
+        resized (bool): Whether to enhance the classification-sized image
+            rather than the full image.
 
-#     # Merge the channels back into the LAB image
-#     lab = cv2.merge((cl, a, b))
+    Returns:
+        np.ndarray | None: A 3D uint8 NumPy array representing the enhanced
+            image, or None if the image expired or was evicted.
 
-#     # Convert back to RGB color space
-#     enhanced_image = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
-#     return Image.fromarray(enhanced_image)
+    """
+    key = f"{img_id}{'_resized' if resized else ''}_{method}"
+    enhanced = load_array(key, replica=True)
+    if enhanced is not None:
+        return enhanced
+
+    img_array = load_array(f"{img_id}_resized" if resized else img_id)
+    if img_array is None and resized:
+        # Stored before resized arrays were precomputed
+        full = load_array(img_id)
+        if full is not None:
+            img_array = np.asarray(Image.fromarray(full).resize(CLASSIFY_SIZE))
+    if img_array is None:
+        return None
+    stats = load(f"{img_id}_stats", touch=False)
+    stats = json.loads(stats) if stats is not None else None
+    enhanced = enhance_image(img_array, method, stats)
+    save_image_data(img_id, {key: enhanced})
+    return enhanced
@@ -0,0 +1,204 @@
+import io, json, os, pickle, tempfile, zipfile
+import numpy as np
+import rasterio
+from rasterio.enums import ColorInterp
+from rasterio.shutil import copy as rio_copy
+from rasterio.transform import from_bounds
+from constants import EXPORT_BLOCK_SIZE
+from utils.storage_utils import exists, load, load_array
+
+CHUNK_SIZE = 64 * 1024
+UNCLASSIFIED = 255
+
+
+def image_bounds(lat, lon, dim):
+    """
+    Computes the geographic bounds of a stored image.
+
+    Args:
+        lat (float): Latitude of the image center.
+        lon (float): Longitude of the image center.
+        dim (float): Width and height of the image in degrees.
+
+    Returns:
+        tuple[float, float, float, float]: The (west, south, east, north) bounds in EPSG:4326.
+
+    """
+    return lon - dim / 2, lat - dim / 2, lon + dim / 2, lat + dim / 2
+
+
+def mask_to_labels(mask_array, class_colors):
+    """
+    Converts a colored mask back into class labels.
+
+    Args:
+        mask_array (np.ndarray): A 3D uint8 NumPy array of the colored mask.
+        class_colors (list[list[int]]): The RGB color of each class.
+
+    Returns:
+        np.ndarray: A 2D uint8 NumPy array of class labels, 255 where no class matches.
+
+    """
+    labels = np.full(mask_array.shape[:2], UNCLASSIFIED, dtype=np.uint8)
+    for i, color in enumerate(class_colors):
+        labels[np.all(mask_array == color, axis=-1)] = i
+    return labels
+
+
+def write_cog(img_id):
+    """
+    Writes a stored image and its label mask to a Cloud-Optimized GeoTIFF.
+
+    The raster is read and written block by block into a tiled, compressed
+    GeoTIFF and then translated to a COG, so the full output never sits in
+    memory. With the disk backend the source arrays are memory-mapped too.
+
+    Args:
+        img_id (str): The id of the stored image.
+
+    Returns:
+        str: Path of the temporary COG file. The caller is responsible for removing it.
+
+    """
+    img = load_array(img_id)
+    img_info = pickle.loads(load(f"{img_id}_metadata"))
+    bounds = image_bounds(
+        float(img_info["lat"]), float(img_info["lon"]), float(img_info["dim"])
+    )
+    height, width = img.shape[:2]
+
+    mask, class_colors = None, None
+    if exists(f"{img_id}_classified"):
+        mask = load_array(f"{img_id}_classified")
+        class_colors = json.loads(load(f"{img_id}_class_colors"))
+
+    profile = {
+        "driver": "GTiff",
+        "width": width,
+        "height": height,
+        "count": 3 if mask is None else 4,
+        "dtype": "uint8",
+        "crs": "EPSG:4326",
+        "transform": from_bounds(*bounds, width, height),
+        "tiled": True,
+        "blockxsize": EXPORT_BLOCK_SIZE,
+        "blockysize": EXPORT_BLOCK_SIZE,
+        "compress": "deflate",
+        # Without these GDAL tags a 4th band as alpha, hiding class 0
+        "photometric": "RGB",
+        "alpha": "UNSPECIFIED",
+    }
+
+    fd, tiled_path = tempfile.mkstemp(suffix=".tif")
+    os.close(fd)
+    fd, cog_path = tempfile.mkstemp(suffix=".tif")
+    os.close(fd)
+    try:
+        with rasterio.open(tiled_path, "w", **profile) as dst:
+            for _, window in dst.block_windows(1):
+                rows = np.arange(
+                    window.row_off, window.row_off + window.height
+                )
+                cols = np.arange(window.col_off, window.col_off + window.width)
+                rgb = img[rows[0] : rows[-1] + 1, cols[0] : cols[-1] + 1]
+                dst.write(np.moveaxis(rgb, -1, 0), [1, 2, 3], window=window)
+                if mask is not None:
+                    # Nearest-neighbour upsampling of the mask, one window at a time
+                    mask_rows = rows * mask.shape[0] // height
+                    mask_cols = cols * mask.shape[1] // width
+                    labels = mask_to_labels(
+                        mask[np.ix_(mask_rows, mask_cols)], class_colors
+                    )
+                    dst.write(labels, 4, window=window)
+            if mask is not None:
+                dst.set_band_description(4, "class")
+                dst.colorinterp = [
+                    ColorInterp.red,
+                    ColorInterp.green,
+                    ColorInterp.blue,
+                    ColorInterp.undefined,
+                ]
+
+        rio_copy(
+            tiled_path,
+            cog_path,
+            driver="COG",
+            compress="deflate",
+            blocksize=EXPORT_BLOCK_SIZE,
+            overview_resampling="nearest",
+        )
+    except Exception:
+        os.remove(cog_path)
+        raise
+    finally:
+        os.remove(tiled_path)
+    return cog_path
+
+
+def stream_file(path, chunk_size=CHUNK_SIZE):
+    """
+    Streams a file in chunks and removes it once fully read.
+
+    Args:
+        path (str): Path of the file to stream.
+        chunk_size (int): Size in bytes of each chunk.
+
+    Yields:
+        bytes: The next chunk of the file.
+
+    """
+    try:
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(path)
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """Write-only stream that hands its content over to a generator."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_cog_archive(img_ids):
+    """
+    Streams a zip archive with one COG per image.
+
+    Images are exported one at a time and the archive is emitted as it is
+    written, so only a single chunk of one image is buffered at once.
+
+    Args:
+        img_ids (list[str]): The ids of the images to export.
+
+    Yields:
+        bytes: The next chunk of the zip archive.
+
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as zf:
+        for img_id in img_ids:
+            if not exists(f"{img_id}_metadata"):
+                continue
+            path = write_cog(img_id)
+            with zf.open(f"{img_id}.tif", "w", force_zip64=True) as entry:
+                for chunk in stream_file(path):
+                    entry.write(chunk)
+                    yield buffer.drain()
+    yield buffer.drain()
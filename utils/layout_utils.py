@@ -6,11 +6,11 @@ import dash_leaflet as dl
 import dash_ag_grid as dag
 from datetime import date
 from utils.chart_utils import create_class_distribution_pie_chart
-from utils.data_utils import to_geojson, update_df
 from dash_extensions import BeforeAfter
 from constants import (
     BUTTON_STYLE,
     COLUMN_DEFS,
+    ENHANCEMENTS,
     MAP_HEIGHT,
     GRID_HEIGHT,
     PANEL_HEIGHT,
@@ -40,6 +40,23 @@ def analysis_modal():
                     style={"width": 250},
                 ),
                 dmc.Space(h=30),
+                dmc.Select(
+                    label="Contrast enhancement",
+                    id="enhancement",
+                    data=[
+                        {"value": k, "label": l}
+                        for k, l in ENHANCEMENTS.items()
+                    ],
+                    value="none",
+                    style={"width": 250},
+                ),
+                dmc.Space(h=30),
+                dmc.Switch(
+                    id="progressive",
+                    label="Progressive preview (single image)",
+                    checked=True,
+                ),
+                dmc.Space(h=30),
                 dmc.Center(
                     dmc.Button("Run classification", id="run-analysis")
                 ),
@@ -49,18 +66,40 @@ def analysis_modal():
     return layout
 
 
-def details_modal(class_proportions, class_colors=None):
+def details_modal(class_proportions, class_colors=None, class_stats=None):
     pie = create_class_distribution_pie_chart(class_proportions, class_colors)
-    layout = dmc.Center(
-        html.Div(
-            [
-                dmc.Text("Proportion of land cover classes across study area"),
-                dmc.Space(h=20),
-                dcc.Graph(figure=pie),
-            ]
+    children = [
+        dmc.Text("Proportion of land cover classes across study area"),
+        dmc.Space(h=20),
+        dcc.Graph(figure=pie),
+    ]
+    if class_stats:
+        children += [dmc.Space(h=20), class_stats_table(class_stats)]
+    layout = dmc.Center(html.Div(children))
+    return layout
+
+
+def class_stats_table(class_stats):
+    header = ["class", "area (km²)", "pixels", "mean R", "mean G", "mean B"]
+    rows = [
+        [i, area, pixels, *means]
+        for i, (area, pixels, means) in enumerate(
+            zip(
+                class_stats["area_km2"],
+                class_stats["pixels"],
+                class_stats["band_means"],
+            )
         )
+    ]
+    return dmc.Table(
+        [
+            html.Thead(html.Tr([html.Th(h) for h in header])),
+            html.Tbody(
+                [html.Tr([html.Td(value) for value in row]) for row in rows]
+            ),
+        ],
+        striped=True,
     )
-    return layout
 
 
 def notify_divs():
@@ -81,10 +120,19 @@ def button_toolkit():
         dmc.Center(html.Button(item.capitalize(), id=item, style=BUTTON_STYLE))
         for item in button_types
     ]
+    buttons.append(
+        dmc.Center(
+            html.A(
+                html.Button("Export", style={**BUTTON_STYLE, "width": "100%"}),
+                id="export-link",
+                style={"width": "80%"},
+            )
+        )
+    )
     return ddk.Block(width=20, children=buttons)
 
 
-def leaflet_map(df):
+def leaflet_map():
     return ddk.Block(
         style={"margin": "10px"},
         width=80,
@@ -105,10 +153,7 @@ def leaflet_map(df):
                             dl.BaseLayer(
                                 name="Study areas",
                                 checked=True,
-                                children=dl.GeoJSON(
-                                    data=to_geojson(df),
-                                    id="geojson",
-                                ),
+                                children=dl.GeoJSON(id="geojson"),
                             ),
                             dl.Overlay(
                                 name="Satellite image",
@@ -120,6 +165,15 @@ def leaflet_map(df):
                                 checked=True,
                                 children=dl.LayerGroup(id="classified-img"),
                             ),
+                            dl.Overlay(
+                                name="Coverage",
+                                checked=False,
+                                children=dl.TileLayer(
+                                    id="coverage",
+                                    url="/api/coverage/{z}/{x}/{y}.png",
+                                    opacity=0.7,
+                                ),
+                            ),
                         ]
                     ),
                     dl.FeatureGroup([dl.EditControl(id="edit-control")]),
@@ -136,7 +190,7 @@ def leaflet_map(df):
     )
 
 
-def image_table(df):
+def image_table():
     return ddk.Block(
         width=85,
         children=[
@@ -145,14 +199,14 @@ def image_table(df):
                     id="image-options",
                     className="ag-theme-material",
                     columnDefs=COLUMN_DEFS,
-                    rowData=df.to_dict("records"),
+                    rowData=[],
                     columnSize="sizeToFit",
                     defaultColDef={
                         "resizable": True,
                         "sortable": True,
                         "filter": True,
                     },
-                    dashGridOptions={"rowSelection": "single"},
+                    dashGridOptions={"rowSelection": "multiple"},
                     style={"height": GRID_HEIGHT, "margin": "10px"},
                 )
             ),
@@ -229,12 +283,13 @@ def download_controls():
 
 
 def layout():
-    df = update_df()
+    # Static page shell: the catalog is filled in by the load_catalog callback
+    # and the modals are rendered when they are opened
     layout = [
         ddk.Row(
             children=[
                 download_controls(),
-                leaflet_map(df),
+                leaflet_map(),
             ]
         ),
         ddk.Card(
@@ -242,7 +297,7 @@ def layout():
                 ddk.CardHeader(title="Select imagery to view"),
                 ddk.Row(
                     [
-                        image_table(df),
+                        image_table(),
                         button_toolkit(),
                     ]
                 ),
@@ -250,6 +305,8 @@ def layout():
             style={"height": PANEL_HEIGHT},
         ),
         html.Div(children=notify_divs()),
+        dcc.Store(id="classify-job"),
+        dcc.Interval(id="classify-poll", interval=1000, disabled=True),
         dmc.Modal(
             title=dmc.Text("Configure Image Analysis", weight=700),
             id="analyze-modal",
@@ -259,7 +316,6 @@ def layout():
         ),
         dmc.Modal(
             title=dmc.Text("Image details", weight=700),
-            children=details_modal([1, 2, 3]),
             id="details-modal",
             size="40%",
             zIndex=10000,
@@ -0,0 +1,116 @@
+import contextvars, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from constants import NASA_KEY, PREFETCH_IMAGERY, PREFETCH_WORKERS
+from utils.data_utils import (
+    PREFETCH_PENDING,
+    PREFETCH_STATS,
+    asset_cache_key,
+    get_asset_metadata,
+    record_prefetch,
+)
+from utils.rate_limit import nasa_get, RateLimitTimeout
+from utils.storage_backends import backend
+from utils.storage_utils import exists, save_value, value_exists
+
+_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+_inflight = set()
+_lock = threading.Lock()
+_last_expiry = 0
+
+PREFETCH_IMAGE_SEC = 60 * 10
+
+
+def _prefetch(lat, lon, dim, date):
+    try:
+        img_metadata = get_asset_metadata(
+            lat, lon, dim, date, priority="batch"
+        )
+        img_id = img_metadata.get("id")
+        if (
+            PREFETCH_IMAGERY
+            and img_id
+            and not exists(f"{img_id}_metadata")
+            and not value_exists(f"prefetch_img_{img_id}")
+        ):
+            record_prefetch("image_requests")
+            img_url = f"https://api.nasa.gov/planetary/earth/imagery?lon={lon}&lat={lat}&date={date}&dim={dim}&api_key={NASA_KEY}"
+            img_data = nasa_get(img_url, priority="batch").content
+            save_value(f"prefetch_img_{img_id}", img_data, PREFETCH_IMAGE_SEC)
+    except RateLimitTimeout:
+        print("Prefetch skipped, NASA API quota is reserved for downloads.")
+    except Exception as e:
+        print(f"Prefetch failed: {e}")
+    finally:
+        with _lock:
+            _inflight.discard(asset_cache_key(lat, lon, dim, date))
+
+
+def prefetch(lat, lon, dim, date):
+    """
+    Fetches the asset metadata of a location in the background.
+
+    Requests go through the rate limiter at batch priority, so they never
+    delay interactive downloads. Locations already cached or being fetched
+    are skipped.
+
+    Args:
+        lat (float): Latitude of the image center.
+        lon (float): Longitude of the image center.
+        dim (float): Width and height of the image in degrees.
+        date (str): Date of the image.
+
+    """
+    key = asset_cache_key(lat, lon, dim, date)
+    with _lock:
+        if key in _inflight or value_exists(key):
+            return
+        _inflight.add(key)
+    record_prefetch("requests")
+    _expire_pending()
+    # Keep the tenant of the request, to skip images it already stored
+    context = contextvars.copy_context()
+    _executor.submit(context.run, _prefetch, lat, lon, dim, date)
+
+
+def _expire_pending(interval=60):
+    # Prefetched entries that expired unused were wasted
+    global _last_expiry
+    if time.time() - _last_expiry < interval:
+        return
+    _last_expiry = time.time()
+    pending = backend.hgetall(PREFETCH_PENDING)
+    expired = [
+        k for k, expiry in pending.items() if float(expiry) <= time.time()
+    ]
+    if expired:
+        backend.hdel(PREFETCH_PENDING, expired)
+        backend.hincrby(PREFETCH_STATS, "wasted", len(expired))
+    return len(pending) - len(expired)
+
+
+def prefetch_stats():
+    """
+    Reports how useful prefetching has been.
+
+    Pending prefetches are cached but not yet used, wasted ones expired
+    unused. Prefetches that failed are neither.
+
+    Returns:
+        dict: Request, hit, pending and wasted counts, and the hit rate.
+
+    """
+    pending = _expire_pending(interval=0)
+    stats = {k: int(v) for k, v in backend.hgetall(PREFETCH_STATS).items()}
+    requests, hits = stats.get("requests", 0), stats.get("hits", 0)
+    image_requests = stats.get("image_requests", 0)
+    image_hits = stats.get("image_hits", 0)
+    return {
+        "requests": requests,
+        "hits": hits,
+        "pending": pending,
+        "wasted": stats.get("wasted", 0),
+        "hit_rate": hits / requests if requests else 0,
+        "image_requests": image_requests,
+        "image_hits": image_hits,
+        "image_hit_rate": image_hits / image_requests if image_requests else 0,
+    }
@@ -0,0 +1,215 @@
+import contextlib, contextvars, cProfile, functools, hashlib, hmac, io, json
+import pstats, random, threading, time, uuid
+import dash
+import flask
+from constants import (
+    ADMIN_TOKEN,
+    PROFILE_CALLBACKS,
+    PROFILE_SAMPLE_RATE,
+    SLOW_CALL_TTL_SEC,
+    SLOW_CALLBACK_SEC,
+)
+from utils.storage_backends import backend
+from utils.tenant_utils import current_tenant
+
+# Stage timings of the callback being profiled, None outside of one
+_stages = contextvars.ContextVar("stages", default=None)
+# The profiled callback that scheduled the current job, None outside of one
+_caller = contextvars.ContextVar("caller", default=None)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Times a stage of the profiled callback that runs it.
+
+    Stages run on scheduler threads are included, as jobs keep the context of
+    the callback that submitted them. Outside of a profiled callback this
+    does nothing.
+
+    Args:
+        name (str): The name of the stage. Repeated stages add up.
+
+    """
+    stages = _stages.get()
+    if stages is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] = stages.get(name, 0) + time.perf_counter() - start
+
+
+def run_profiled(fn, *args):
+    """
+    Runs a scheduled job, timed and profiled like the callback that submitted
+    it.
+
+    cProfile only follows the thread that enables it, so jobs of a sampled
+    callback profile themselves. Jobs finishing before the callback is
+    recorded add their stages and profile to the callback's, while slower
+    background jobs are recorded as slow calls of their own. Work handed to
+    process pools is not profiled.
+
+    Args:
+        fn (callable): The job to run.
+
+    Returns:
+        The result of the job.
+
+    """
+    caller = _caller.get()
+    if caller is None:
+        return fn(*args)
+    stages = {}
+    token = _stages.set(stages)
+    profiler = cProfile.Profile() if caller["sampled"] else None
+    profilers = [] if profiler is None else [profiler]
+    start = time.perf_counter()
+    try:
+        if profiler is None:
+            return fn(*args)
+        return profiler.runcall(fn, *args)
+    finally:
+        elapsed = time.perf_counter() - start
+        _stages.reset(token)
+        with caller["lock"]:
+            merged = not caller["recorded"]
+            if merged:
+                for name, sec in stages.items():
+                    caller["stages"][name] = (
+                        caller["stages"].get(name, 0) + sec
+                    )
+                caller["profilers"] += profilers
+        if not merged and elapsed > SLOW_CALLBACK_SEC:
+            _record(fn.__name__, args, elapsed, stages, profilers)
+
+
+def inputs_digest(args):
+    """Returns a short digest identifying the inputs of a callback call."""
+    encoded = json.dumps(args, sort_keys=True, default=str).encode("utf8")
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+
+def _format_profile(profilers, limit=40):
+    out = io.StringIO()
+    stats = pstats.Stats(*profilers, stream=out)
+    stats.sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+
+def profiled(fn):
+    """
+    Records calls of a Dash callback slower than ``SLOW_CALLBACK_SEC``.
+
+    Calls are only timed, except for a ``PROFILE_SAMPLE_RATE`` fraction that
+    run under cProfile, along with the jobs they schedule (see
+    ``run_profiled``). A slow call is stored with its callback id, inputs
+    digest, stage timings and, if sampled, its profile. Without
+    ``PROFILE_CALLBACKS`` the callback is returned unchanged.
+
+    Args:
+        fn (callable): The callback to profile.
+
+    Returns:
+        callable: The wrapped callback.
+
+    """
+    if not PROFILE_CALLBACKS:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(*args):
+        stages = {}
+        token = _stages.set(stages)
+        profiler = (
+            cProfile.Profile()
+            if random.random() < PROFILE_SAMPLE_RATE
+            else None
+        )
+        caller = {
+            "sampled": profiler is not None,
+            "stages": stages,
+            "profilers": [] if profiler is None else [profiler],
+            "recorded": False,
+            "lock": threading.Lock(),
+        }
+        caller_token = _caller.set(caller)
+        start = time.perf_counter()
+        try:
+            if profiler is None:
+                return fn(*args)
+            return profiler.runcall(fn, *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            _caller.reset(caller_token)
+            _stages.reset(token)
+            with caller["lock"]:
+                # Jobs finishing from now on are recorded on their own
+                caller["recorded"] = True
+                stages, profilers = dict(stages), list(caller["profilers"])
+            if elapsed > SLOW_CALLBACK_SEC:
+                _record(fn.__name__, args, elapsed, stages, profilers)
+
+    return wrapper
+
+
+def _record(name, args, elapsed, stages, profilers):
+    try:
+        triggered = dash.callback_context.triggered_id
+    except Exception:
+        triggered = None
+    call = {
+        "id": f"{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}",
+        "callback": name,
+        "triggered": str(triggered) if triggered is not None else None,
+        "tenant": current_tenant(),
+        "time": time.time(),
+        "elapsed_sec": elapsed,
+        "inputs_digest": inputs_digest(args),
+        "stages": stages,
+        "profile": _format_profile(profilers) if profilers else None,
+    }
+    print(f"Slow callback {name}: {elapsed:.2f}s, stages {stages}")
+    backend.set_many(
+        {f"slow_call_{call['id']}": json.dumps(call).encode("utf8")},
+        ttl=SLOW_CALL_TTL_SEC,
+    )
+
+
+def slow_calls(limit=50):
+    """
+    Returns the most recent slow callback calls, without their profiles.
+
+    Args:
+        limit (int): The maximum number of calls to return.
+
+    Returns:
+        list[dict]: The calls, most recent first.
+
+    """
+    keys = sorted(backend.scan("slow_call_*"), reverse=True)[:limit]
+    calls = []
+    for value in map(backend.get, keys):
+        if value is not None:
+            call = json.loads(value)
+            call["profiled"] = call.pop("profile") is not None
+            calls.append(call)
+    return calls
+
+
+def slow_call(call_id):
+    """Returns a recorded slow call with its profile, or None."""
+    value = backend.get(f"slow_call_{call_id}")
+    return json.loads(value) if value is not None else None
+
+
+def require_admin():
+    """Aborts the request unless it carries ``ADMIN_TOKEN`` as a bearer token."""
+    if not ADMIN_TOKEN:
+        flask.abort(404)
+    auth = flask.request.headers.get("Authorization", "")
+    if not hmac.compare_digest(auth, f"Bearer {ADMIN_TOKEN}"):
+        flask.abort(401)
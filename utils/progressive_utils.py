@@ -0,0 +1,272 @@
+import json, time, uuid
+import numpy as np
+from constants import PROGRESSIVE_TILE_SIZE
+from utils.data_utils import (
+    classify_images,
+    create_colored_mask_image,
+    fit_kmeans_model,
+    load_enhanced,
+    load_preprocessed,
+    predict_segmentation,
+    save_classification,
+)
+from utils.profiling_utils import stage
+from utils.scheduler import classification_scheduler
+from utils.storage_utils import (
+    delete_value,
+    load_array,
+    load_value,
+    namespaced,
+    save_value,
+)
+from utils.tenant_utils import (
+    acquire_job_slot,
+    release_job_slot,
+    renew_job_slot,
+)
+
+# Previews only need to outlive the polling that displays them
+PROGRESS_TTL_SEC = 60 * 10
+
+
+def _progress_key(img_id):
+    return f"progress_{namespaced(img_id)}"
+
+
+def _tile_key(img_id, i):
+    return f"progress_{namespaced(img_id)}_tile_{i}"
+
+
+def _save_progress(img_id, progress):
+    save_value(_progress_key(img_id), json.dumps(progress), PROGRESS_TTL_SEC)
+
+
+def _classify(img_id, n_classes, enhancement, slot):
+    try:
+        # The slot may have waited in the queue for most of its lease
+        renew_job_slot(slot)
+        # Coarse pass on the array resized at ingest time
+        coarse = load_preprocessed(img_id, enhancement)
+        model = fit_kmeans_model([coarse], n_classes)
+        coarse_mask, _ = create_colored_mask_image(
+            predict_segmentation(model, coarse), n_classes
+        )
+        save_value(
+            _tile_key(img_id, "coarse"),
+            np.asarray(coarse_mask).tobytes(),
+            PROGRESS_TTL_SEC,
+        )
+
+        # Refinement at full resolution, one tile at a time
+        if enhancement != "none":
+            img = load_enhanced(img_id, enhancement, resized=False)
+        else:
+            img = load_array(img_id, touch=False, replica=True)
+        height, width = img.shape[:2]
+        size = PROGRESSIVE_TILE_SIZE
+        tiles = [
+            [row, col, min(row + size, height), min(col + size, width)]
+            for row in range(0, height, size)
+            for col in range(0, width, size)
+        ]
+        progress = {
+            "coarse_shape": list(np.asarray(coarse_mask).shape),
+            "tiles": tiles,
+            "done": 0,
+            "finished": False,
+        }
+        _save_progress(img_id, progress)
+
+        segmentation = np.empty((height, width), dtype=np.int32)
+        for i, (row0, col0, row1, col1) in enumerate(tiles):
+            tile = img[row0:row1, col0:col1].astype(np.float32) / 255
+            labels = predict_segmentation(model, tile)
+            segmentation[row0:row1, col0:col1] = labels
+            tile_mask, _ = create_colored_mask_image(labels, n_classes)
+            save_value(
+                _tile_key(img_id, i),
+                np.asarray(tile_mask).tobytes(),
+                PROGRESS_TTL_SEC,
+            )
+            progress["done"] = i + 1
+            _save_progress(img_id, progress)
+            renew_job_slot(slot)
+
+        save_classification(img_id, "k-means", n_classes, segmentation)
+        progress["finished"] = True
+        _save_progress(img_id, progress)
+    except Exception as e:
+        print(f"Progressive classification of {img_id} failed: {e}")
+        _save_progress(img_id, {"error": str(e), "finished": True})
+    finally:
+        release_job_slot(slot)
+
+
+def start_progressive_classification(img_id, n_classes, enhancement="none"):
+    """
+    Classifies an image in the background, publishing previews as it goes.
+
+    A coarse classification of the downsampled image is published first.
+    Full-resolution tiles follow, predicted with the model fit on the coarse
+    pass, and the assembled result is stored like any other classification.
+
+    Args:
+        img_id (str): The id of the image to classify.
+        n_classes (int): The number of classes to use for the classification.
+        enhancement (str): The contrast enhancement to apply, one of the ``ENHANCEMENTS``.
+
+    Raises:
+        TenantQuotaExceeded: If all of the tenant's job slots are in use.
+
+    """
+    # The job slot is held until the background job finishes
+    slot = acquire_job_slot()
+    delete_value(_progress_key(img_id))
+    classification_scheduler.submit(
+        _classify, img_id, n_classes, enhancement, slot
+    )
+
+
+def get_progress(img_id, sent):
+    """
+    Returns the previews of a progressive classification not yet displayed.
+
+    Args:
+        img_id (str): The id of the image being classified.
+        sent (int): The number of tiles already displayed, -1 if the coarse preview wasn't.
+
+    Returns:
+        tuple[dict | None, np.ndarray | None, list]: The progress state, the coarse preview
+            if not yet displayed, and the new (tile bounds in pixels, colored tile) pairs.
+            The state is flagged ``expired`` if previews to display expired.
+
+    """
+    progress = load_value(_progress_key(img_id))
+    if progress is None:
+        return None, None, []
+    progress = json.loads(progress)
+    if "error" in progress:
+        return progress, None, []
+
+    # Previews expire after PROGRESS_TTL_SEC, polling may resume too late
+    expired = {**progress, "expired": True}
+    coarse = None
+    if sent < 0:
+        coarse = load_value(_tile_key(img_id, "coarse"))
+        if coarse is None:
+            return expired, None, []
+        shape = progress["coarse_shape"]
+        coarse = np.frombuffer(coarse, dtype=np.uint8).reshape(shape)
+
+    tiles = []
+    for i in range(max(sent, 0), progress["done"]):
+        row0, col0, row1, col1 = progress["tiles"][i]
+        tile = load_value(_tile_key(img_id, i))
+        if tile is None:
+            return expired, None, []
+        tile = np.frombuffer(tile, np.uint8)
+        tiles.append(
+            (progress["tiles"][i], tile.reshape((row1 - row0, col1 - col0, 3)))
+        )
+    return progress, coarse, tiles
+
+
+def _batch_progress_key(job_id):
+    return _progress_key(f"batch_{job_id}")
+
+
+def _classify_batch(job_id, img_ids, model, n_classes, enhancement, slot):
+    key = _batch_progress_key(job_id)
+    progress = {
+        "total": len(img_ids),
+        "classified": 0,
+        "missing": [],
+        "elapsed": 0,
+        "finished": False,
+    }
+    start = time.perf_counter()
+    try:
+        # The slot may have waited in the queue for most of its lease
+        renew_job_slot(slot)
+        with stage("load"):
+            image_arrays = {
+                img_id: load_preprocessed(img_id, enhancement)
+                for img_id in img_ids
+            }
+        # Images may have expired or been evicted since they were listed
+        missing = [img_id for img_id, a in image_arrays.items() if a is None]
+        found = [img_id for img_id in img_ids if img_id not in missing]
+        progress["missing"] = missing
+        save_value(key, json.dumps(progress), PROGRESS_TTL_SEC)
+        if found:
+            arrays = [image_arrays[img_id] for img_id in found]
+            for i, segmentation in classify_images(arrays, n_classes):
+                with stage("store"):
+                    if save_classification(
+                        found[i], model, n_classes, segmentation
+                    ):
+                        progress["classified"] += 1
+                    else:
+                        missing.append(found[i])
+                progress["elapsed"] = time.perf_counter() - start
+                save_value(key, json.dumps(progress), PROGRESS_TTL_SEC)
+                renew_job_slot(slot)
+        progress["elapsed"] = time.perf_counter() - start
+        progress["finished"] = True
+        save_value(key, json.dumps(progress), PROGRESS_TTL_SEC)
+    except Exception as e:
+        print(f"Batch classification {job_id} failed: {e}")
+        save_value(
+            key,
+            json.dumps({"error": str(e), "finished": True}),
+            PROGRESS_TTL_SEC,
+        )
+    finally:
+        release_job_slot(slot)
+
+
+def start_batch_classification(img_ids, model, n_classes, enhancement="none"):
+    """
+    Classifies a batch of images in the background with a shared model.
+
+    Progress is published after every image, to be polled with
+    ``get_batch_progress``.
+
+    Args:
+        img_ids (list[str]): The ids of the images to classify.
+        model (str): The name of the classification model.
+        n_classes (int): The number of classes to use for the classification.
+        enhancement (str): The contrast enhancement to apply, one of the ``ENHANCEMENTS``.
+
+    Returns:
+        str: The id of the job.
+
+    Raises:
+        TenantQuotaExceeded: If all of the tenant's job slots are in use.
+
+    """
+    # The job slot is held until the background job finishes, and the job is
+    # queued behind the jobs of other tenants rather than ahead of them
+    slot = acquire_job_slot()
+    job_id = uuid.uuid4().hex
+    classification_scheduler.submit(
+        _classify_batch, job_id, img_ids, model, n_classes, enhancement, slot
+    )
+    return job_id
+
+
+def get_batch_progress(job_id):
+    """
+    Returns the progress of a batch classification.
+
+    Args:
+        job_id (str): The id returned by ``start_batch_classification``.
+
+    Returns:
+        dict | None: The number of images in the batch and classified so far, the ids of
+            images no longer stored, the elapsed seconds and whether the job finished, or
+            an error. None until the job has started.
+
+    """
+    progress = load_value(_batch_progress_key(job_id))
+    return json.loads(progress) if progress is not None else None
@@ -0,0 +1,190 @@
+import logging, time, uuid
+import redis
+import requests
+from constants import (
+    redis_instance,
+    NASA_RATE_LIMIT_PER_HOUR,
+    NASA_RATE_LIMIT_BURST,
+    NASA_BATCH_RESERVE,
+    NASA_MAX_WAIT_SEC,
+)
+
+logger = logging.getLogger(__name__)
+
+PRIORITIES = ["interactive", "batch"]
+
+# Keys share a hash tag so the scripts can touch them together on a cluster
+BUCKET = "{nasa_limiter}:bucket"
+STATS = "{nasa_limiter}:stats"
+
+
+# Seconds a deferred batch request waits before asking again
+DEFER_SEC = 0.1
+# Waiters expire this long after their own timeout, so one killed while
+# waiting doesn't count as waiting forever
+WAITER_GRACE_SEC = 5
+
+
+def _waiting(priority):
+    # Sorted set of waiter ids, scored by the time they expire
+    return f"{{nasa_limiter}}:waiters:{priority}"
+
+
+# Refills the bucket and takes a token. Batch requests leave a reserve of
+# tokens untouched and yield to any interactive request that is waiting.
+_ACQUIRE = redis_instance.register_script(
+    """
+    local rate = tonumber(ARGV[1])
+    local capacity = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local reserve = tonumber(ARGV[4])
+    local state = redis.call("HMGET", KEYS[1], "tokens", "updated")
+    local tokens = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    redis.call("ZREMRANGEBYSCORE", KEYS[2], "-inf", now)
+    local defer = reserve > 0 and redis.call("ZCARD", KEYS[2]) > 0
+    local granted = 0
+    if not defer and tokens >= 1 + reserve then
+        tokens = tokens - 1
+        granted = 1
+    end
+    redis.call("HSET", KEYS[1], "tokens", tokens, "updated", now)
+    return {granted, tostring((1 + reserve - tokens) / rate)}
+    """
+)
+
+# Lowers the bucket to what the API reports as remaining
+_OBSERVE = redis_instance.register_script(
+    """
+    local remaining = tonumber(ARGV[1])
+    local tokens = tonumber(redis.call("HGET", KEYS[1], "tokens"))
+    if tokens == nil or tokens > remaining then
+        redis.call("HSET", KEYS[1], "tokens", remaining, "updated", ARGV[2])
+    end
+    redis.call("HSET", KEYS[2], "last_remaining", remaining)
+    """
+)
+
+
+class RateLimitTimeout(Exception):
+    """Raised when no NASA API token became available in time."""
+
+
+def acquire(priority="interactive", timeout=NASA_MAX_WAIT_SEC):
+    """
+    Blocks until a NASA API request may be sent.
+
+    The token bucket is shared by every worker through Redis. If Redis is
+    unreachable the request is let through rather than failing the user.
+
+    Args:
+        priority (str): "interactive" for user-triggered downloads, "batch" for background work.
+        timeout (float): Maximum number of seconds to wait for a token.
+
+    Returns:
+        float: The number of seconds spent waiting.
+
+    Raises:
+        RateLimitTimeout: If no token became available within ``timeout``.
+
+    """
+    rate = NASA_RATE_LIMIT_PER_HOUR / 3600
+    reserve = NASA_BATCH_RESERVE if priority == "batch" else 0
+    start = time.monotonic()
+    waiter = uuid.uuid4().hex
+    try:
+        deadline = time.time() + timeout + WAITER_GRACE_SEC
+        redis_instance.zadd(_waiting(priority), {waiter: deadline})
+        try:
+            while True:
+                granted, wait = _ACQUIRE(
+                    keys=[BUCKET, _waiting("interactive")],
+                    args=[rate, NASA_RATE_LIMIT_BURST, time.time(), reserve],
+                )
+                waited = time.monotonic() - start
+                if granted:
+                    break
+                # Deferred to an interactive request with tokens to spare
+                wait = max(float(wait), DEFER_SEC)
+                if waited + wait > timeout:
+                    raise RateLimitTimeout(
+                        f"No NASA API quota available within {timeout}s"
+                    )
+                time.sleep(min(wait, 1))
+        finally:
+            redis_instance.zrem(_waiting(priority), waiter)
+        pipe = redis_instance.pipeline(transaction=False)
+        pipe.hincrby(STATS, f"requests_{priority}", 1)
+        pipe.hincrbyfloat(STATS, f"wait_sec_{priority}", waited)
+        pipe.execute()
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+        logger.warning(
+            "Redis unavailable, NASA API calls are not rate limited"
+        )
+        waited = time.monotonic() - start
+    return waited
+
+
+def observe(response):
+    """Adapts the bucket to the quota the NASA API reports as remaining."""
+    remaining = response.headers.get("X-RateLimit-Remaining")
+    if response.status_code == 429:
+        remaining = 0
+    if remaining is None:
+        return
+    try:
+        _OBSERVE(keys=[BUCKET, STATS], args=[int(remaining), time.time()])
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+        pass
+
+
+def nasa_get(url, priority="interactive"):
+    """
+    Sends a GET request to the NASA API through the shared rate limiter.
+
+    Args:
+        url (str): The request URL.
+        priority (str): "interactive" or "batch", see ``acquire``.
+
+    Returns:
+        requests.Response: The API response.
+
+    """
+    acquire(priority)
+    response = requests.get(url)
+    observe(response)
+    return response
+
+
+def limiter_stats():
+    """
+    Reports the state of the NASA API rate limiter.
+
+    Returns:
+        dict: Tokens left, queue depth and average wait per priority, and the
+            last remaining quota reported by the API.
+
+    """
+    bucket = redis_instance.hgetall(BUCKET)
+    stats = {
+        k.decode("utf8"): float(v)
+        for k, v in redis_instance.hgetall(STATS).items()
+    }
+    report = {
+        "tokens": float(bucket.get(b"tokens", NASA_RATE_LIMIT_BURST)),
+        "burst": NASA_RATE_LIMIT_BURST,
+        "quota_per_hour": NASA_RATE_LIMIT_PER_HOUR,
+        "last_remaining": stats.get("last_remaining"),
+    }
+    for priority in PRIORITIES:
+        requests_sent = stats.get(f"requests_{priority}", 0)
+        wait = stats.get(f"wait_sec_{priority}", 0)
+        report[priority] = {
+            "queue_depth": redis_instance.zcount(
+                _waiting(priority), time.time(), "+inf"
+            ),
+            "requests": int(requests_sent),
+            "avg_wait_sec": wait / requests_sent if requests_sent else 0,
+        }
+    return report
@@ -0,0 +1,86 @@
+import collections, contextvars, threading
+from concurrent.futures import Future
+from constants import CLASSIFY_JOB_WORKERS
+from utils.profiling_utils import run_profiled
+from utils.tenant_utils import current_tenant
+
+
+class FairScheduler:
+    """
+    Runs jobs on a fixed set of threads, round-robin across tenants.
+
+    Each tenant has its own FIFO queue, and idle threads take the next job
+    from the next tenant that has one. A tenant that queues many jobs only
+    delays its own, so the wait of other tenants stays bounded by the number
+    of active tenants rather than by the length of the backlog.
+
+    Queues are per process: each gunicorn worker runs its own scheduler, so
+    tenants are only arbitrated against the jobs of the same worker. Job
+    slots, held in the shared store, still bound each tenant across workers.
+    """
+
+    def __init__(self, workers):
+        self._queues = collections.OrderedDict()
+        self._condition = threading.Condition()
+        self._workers = workers
+        self._threads = []
+
+    def _start(self):
+        # Threads are started lazily so they are created in each gunicorn
+        # worker rather than in the preloading master
+        self._threads = [t for t in self._threads if t.is_alive()]
+        while len(self._threads) < self._workers:
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn, *args, tenant=None):
+        """
+        Queues a job for a tenant, the current one by default.
+
+        The job runs in a copy of the caller's context, so it keeps the
+        caller's tenant and is profiled along with the caller.
+
+        Returns:
+            concurrent.futures.Future: The future result of the job.
+
+        """
+        tenant = tenant or current_tenant()
+        future = Future()
+        context = contextvars.copy_context()
+        with self._condition:
+            self._start()
+            queue = self._queues.setdefault(tenant, collections.deque())
+            queue.append((future, context, fn, args))
+            self._condition.notify()
+        return future
+
+    def _next(self):
+        with self._condition:
+            while not self._queues:
+                self._condition.wait()
+            tenant, queue = next(iter(self._queues.items()))
+            job = queue.popleft()
+            # Move the tenant to the back of the line
+            del self._queues[tenant]
+            if queue:
+                self._queues[tenant] = queue
+            return job
+
+    def _run(self):
+        while True:
+            future, context, fn, args = self._next()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(context.run(run_profiled, fn, *args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def queue_depths(self):
+        """Returns the number of queued jobs of each tenant."""
+        with self._condition:
+            return {tenant: len(q) for tenant, q in self._queues.items()}
+
+
+classification_scheduler = FairScheduler(CLASSIFY_JOB_WORKERS)
@@ -0,0 +1,83 @@
+import logging
+import flask
+from flask_compress import Compress
+from constants import (
+    COMPRESS_MIN_BYTES,
+    PAYLOAD_BUDGET_BYTES,
+    PAYLOAD_BUDGETS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def configure_compression(server):
+    """
+    Compresses responses of the Flask server with brotli or gzip.
+
+    Streamed responses (exports) are left untouched so they keep streaming,
+    and responses smaller than ``COMPRESS_MIN_BYTES`` are not worth the CPU.
+
+    Args:
+        server (flask.Flask): The server to configure.
+
+    """
+    server.config.update(
+        COMPRESS_ALGORITHM=["br", "gzip"],
+        COMPRESS_MIN_SIZE=COMPRESS_MIN_BYTES,
+        COMPRESS_BR_LEVEL=4,
+        COMPRESS_LEVEL=6,
+        COMPRESS_STREAMS=False,
+    )
+    Compress(server)
+
+
+def callback_budget(outputs):
+    """
+    Returns the payload budget of a callback.
+
+    Args:
+        outputs (str): The output id of the callback, as sent by the Dash renderer.
+
+    Returns:
+        int: The budget in bytes, the largest configured for any of its outputs.
+
+    """
+    budgets = [
+        budget
+        for output, budget in PAYLOAD_BUDGETS.items()
+        if output in outputs
+    ]
+    return max(budgets, default=PAYLOAD_BUDGET_BYTES)
+
+
+def register_payload_budgets(server):
+    """
+    Warns when a callback response exceeds its payload budget.
+
+    Sizes are measured before compression, so this must be registered after
+    ``configure_compression``: Flask runs ``after_request`` hooks in reverse.
+
+    Args:
+        server (flask.Flask): The server to monitor.
+
+    """
+
+    @server.after_request
+    def check_payload_budget(response):
+        if (
+            not flask.request.path.endswith("/_dash-update-component")
+            or response.is_streamed
+        ):
+            return response
+        body = flask.request.get_json(silent=True) or {}
+        outputs = body.get("output", "")
+        size = response.content_length or len(response.get_data())
+        budget = callback_budget(outputs)
+        if size > budget:
+            logger.warning(
+                "Callback %s returned %d bytes, over its %d byte budget",
+                outputs,
+                size,
+                budget,
+            )
+        return response
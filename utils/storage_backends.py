@@ -0,0 +1,379 @@
+import abc, fnmatch, hashlib, io, os, random, sqlite3, tempfile, threading
+import time
+import numpy as np
+import redis
+from constants import (
+    redis_instance,
+    redis_replicas,
+    STORAGE_BACKEND,
+    STORAGE_DIR,
+)
+
+
+class StorageBackend(abc.ABC):
+    """
+    Interface of the key-value stores that hold imagery and its metadata.
+
+    Values are either bytes or NumPy arrays. Arrays are read back with
+    ``get_array``, which backends may serve without copying. Hashes hold the
+    bookkeeping of the image store (sizes, access times, counters). Backends
+    missing any of the abstract methods cannot be instantiated.
+    """
+
+    @abc.abstractmethod
+    def get(self, key):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_array(self, key, replica=False):
+        """Reads an array, from a read replica if ``replica`` and the backend has any."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_many(self, values, ttl=None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, keys):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def exists_many(self, keys):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def expire(self, keys, ttl):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def scan(self, pattern):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def hgetall(self, name):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def hmget(self, name, fields):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def hset(self, name, mapping):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def hincrby(self, name, field, amount=1):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def hdel(self, name, fields):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def memory_usage(self):
+        raise NotImplementedError
+
+    def pool_stats(self):
+        """Reports the utilization of the backend's connection pools."""
+        return {}
+
+    def exists(self, key):
+        return self.exists_many([key])[0]
+
+
+def _decode(value):
+    return value.decode("utf8") if isinstance(value, bytes) else value
+
+
+def _pool_stats(pool):
+    if isinstance(pool, redis.BlockingConnectionPool):
+        created = len(pool._connections)
+        idle = sum(c is not None for c in list(pool.pool.queue))
+    else:
+        created = pool._created_connections
+        idle = len(pool._available_connections)
+    return {
+        "max": pool.max_connections,
+        "created": created,
+        "in_use": created - idle,
+        "idle": idle,
+    }
+
+
+def _client_pool_stats(client):
+    if isinstance(client, redis.RedisCluster):
+        return {
+            node.name: _pool_stats(node.redis_connection.connection_pool)
+            for node in client.get_nodes()
+            if node.redis_connection is not None
+        }
+    return _pool_stats(client.connection_pool)
+
+
+class RedisBackend(StorageBackend):
+    """Stores everything in Redis. Arrays are serialized in the ``.npy`` format."""
+
+    def __init__(self, client=redis_instance, replicas=redis_replicas):
+        self.client = client
+        self.replicas = replicas
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def get_array(self, key, replica=False):
+        value = None
+        if replica and self.replicas:
+            try:
+                value = random.choice(self.replicas).get(key)
+            except redis.exceptions.RedisError as e:
+                print(f"Replica read failed, reading from the primary: {e}")
+        # Keys written moments ago may not have been replicated yet
+        if value is None:
+            value = self.client.get(key)
+        if value is None:
+            return None
+        return np.load(io.BytesIO(value), allow_pickle=False)
+
+    def set_many(self, values, ttl=None):
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in values.items():
+            if isinstance(value, np.ndarray):
+                buffer = io.BytesIO()
+                np.save(buffer, value, allow_pickle=False)
+                value = buffer.getvalue()
+            pipe.set(key, value, ex=ttl)
+        pipe.execute()
+
+    def delete(self, keys):
+        if keys:
+            self.client.delete(*keys)
+
+    def exists_many(self, keys):
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.exists(key)
+        return [bool(found) for found in pipe.execute()]
+
+    def expire(self, keys, ttl):
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.expire(key, ttl)
+        pipe.execute()
+
+    def scan(self, pattern):
+        return [_decode(key) for key in self.client.scan_iter(match=pattern)]
+
+    def hgetall(self, name):
+        return {
+            _decode(k): _decode(v)
+            for k, v in self.client.hgetall(name).items()
+        }
+
+    def hmget(self, name, fields):
+        return [_decode(v) for v in self.client.hmget(name, fields)]
+
+    def hset(self, name, mapping):
+        if mapping:
+            self.client.hset(name, mapping=mapping)
+
+    def hincrby(self, name, field, amount=1):
+        return self.client.hincrby(name, field, amount)
+
+    def hdel(self, name, fields):
+        if fields:
+            self.client.hdel(name, *fields)
+
+    def memory_usage(self):
+        info = self.client.info("memory")
+        if "used_memory" not in info:
+            # Redis Cluster reports each node separately
+            return sum(node.get("used_memory", 0) for node in info.values())
+        return info["used_memory"]
+
+    def pool_stats(self):
+        return {
+            "primary": _client_pool_stats(self.client),
+            "replicas": [_client_pool_stats(c) for c in self.replicas],
+        }
+
+
+class DiskBackend(StorageBackend):
+    """
+    Stores arrays as memory-mapped ``.npy`` files and everything else in SQLite.
+
+    Arrays are read with ``np.load(mmap_mode="r")``, so reads map the file
+    instead of copying it into the process. Expired keys are hidden on read
+    and purged lazily on write.
+    """
+
+    def __init__(self, root=STORAGE_DIR):
+        self.root = root
+        os.makedirs(os.path.join(root, "arrays"), exist_ok=True)
+        self._local = threading.local()
+        self._last_purge = 0
+        with self._connection() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, "
+                "value BLOB, path TEXT, expires REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS hashes (name TEXT, field TEXT, "
+                "value TEXT, PRIMARY KEY (name, field))"
+            )
+
+    def _connection(self):
+        # Connections can't be shared across threads or forked workers
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._local.conn = sqlite3.connect(
+                os.path.join(self.root, "store.sqlite3"), timeout=30
+            )
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def _array_path(self, key):
+        digest = hashlib.sha1(key.encode("utf8")).hexdigest()
+        return os.path.join(self.root, "arrays", f"{digest}.npy")
+
+    def _live(self, key):
+        row = (
+            self._connection()
+            .execute(
+                "SELECT value, path FROM entries WHERE key = ? "
+                "AND (expires IS NULL OR expires > ?)",
+                (key, time.time()),
+            )
+            .fetchone()
+        )
+        return row
+
+    def get(self, key):
+        row = self._live(key)
+        if row is None:
+            return None
+        if row[1] is not None:
+            with open(row[1], "rb") as f:
+                return f.read()
+        return row[0]
+
+    def get_array(self, key, replica=False):
+        row = self._live(key)
+        if row is None:
+            return None
+        if row[1] is None:
+            return np.load(io.BytesIO(row[0]), allow_pickle=False)
+        return np.load(row[1], mmap_mode="r", allow_pickle=False)
+
+    def set_many(self, values, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        rows = []
+        for key, value in values.items():
+            if isinstance(value, np.ndarray):
+                path = self._array_path(key)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, value, allow_pickle=False)
+                os.replace(tmp_path, path)
+                rows.append((key, None, path, expires))
+            else:
+                rows.append((key, value, None, expires))
+        with self._connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", rows
+            )
+        self._purge_expired()
+
+    def delete(self, keys):
+        with self._connection() as conn:
+            for key in keys:
+                row = conn.execute(
+                    "SELECT path FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                if row and row[0] and os.path.exists(row[0]):
+                    os.remove(row[0])
+
+    def exists_many(self, keys):
+        return [self._live(key) is not None for key in keys]
+
+    def expire(self, keys, ttl):
+        with self._connection() as conn:
+            conn.executemany(
+                "UPDATE entries SET expires = ? WHERE key = ?",
+                [(time.time() + ttl, key) for key in keys],
+            )
+
+    def scan(self, pattern):
+        rows = self._connection().execute(
+            "SELECT key FROM entries WHERE expires IS NULL OR expires > ?",
+            (time.time(),),
+        )
+        return [key for (key,) in rows if fnmatch.fnmatchcase(key, pattern)]
+
+    def hgetall(self, name):
+        rows = self._connection().execute(
+            "SELECT field, value FROM hashes WHERE name = ?", (name,)
+        )
+        return dict(rows)
+
+    def hmget(self, name, fields):
+        values = self.hgetall(name)
+        return [values.get(field) for field in fields]
+
+    def hset(self, name, mapping):
+        with self._connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)",
+                [(name, k, str(v)) for k, v in mapping.items()],
+            )
+
+    def hincrby(self, name, field, amount=1):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO hashes VALUES (?, ?, ?) ON CONFLICT (name, field) "
+                "DO UPDATE SET value = CAST(value AS INTEGER) + ?",
+                (name, field, str(amount), amount),
+            )
+            (value,) = conn.execute(
+                "SELECT value FROM hashes WHERE name = ? AND field = ?",
+                (name, field),
+            ).fetchone()
+        return int(value)
+
+    def hdel(self, name, fields):
+        with self._connection() as conn:
+            conn.executemany(
+                "DELETE FROM hashes WHERE name = ? AND field = ?",
+                [(name, field) for field in fields],
+            )
+
+    def memory_usage(self):
+        arrays = os.path.join(self.root, "arrays")
+        return sum(
+            os.path.getsize(os.path.join(arrays, f))
+            for f in os.listdir(arrays)
+        ) + os.path.getsize(os.path.join(self.root, "store.sqlite3"))
+
+    def _purge_expired(self, interval=60):
+        if time.time() - self._last_purge < interval:
+            return
+        self._last_purge = time.time()
+        rows = (
+            self._connection()
+            .execute(
+                "SELECT key FROM entries WHERE expires <= ?", (time.time(),)
+            )
+            .fetchall()
+        )
+        self.delete([key for (key,) in rows])
+
+
+def get_backend(name=STORAGE_BACKEND):
+    """Creates the storage backend selected by the ``STORAGE_BACKEND`` variable."""
+    backends = {"redis": RedisBackend, "disk": DiskBackend}
+    if name not in backends:
+        raise ValueError(f"Unknown storage backend: {name}")
+    return backends[name]()
+
+
+backend = get_backend()
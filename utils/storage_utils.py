@@ -0,0 +1,307 @@
+import time
+import numpy as np
+from constants import (
+    ENHANCEMENTS,
+    REDIS_EXPIRE_SEC,
+    STORAGE_BUDGET_BYTES,
+    STORAGE_EVICTION_POLICY,
+    TENANT_QUOTA_BYTES,
+)
+from utils.storage_backends import backend
+from utils.tenant_utils import current_tenant
+
+# Every key derived from an image id, evicted and expired as one group
+IMAGE_KEY_SUFFIXES = [
+    "",
+    "_metadata",
+    "_resized",
+    "_thumb",
+    "_stats",
+    "_classified",
+    "_class_colors",
+    "_class_stats",
+] + [
+    f"{resolution}_{method}"
+    for resolution in ["", "_resized"]
+    for method in ENHANCEMENTS
+    if method != "none"
+]
+
+# Accounting hashes, keyed by namespaced image id ("{<tenant>:<image id>}")
+IMAGE_BYTES = "storage_image_bytes"  # image id -> bytes across its keys
+KEY_BYTES = "storage_key_bytes"  # key -> bytes
+LAST_ACCESS = "storage_last_access"  # image id -> last access timestamp
+HITS = "storage_hits"  # image id -> number of reads
+# Tenant -> counter bumped whenever an image is added to or removed from its
+# catalog, to invalidate anything derived from the catalog as a whole
+CATALOG_VERSIONS = "catalog_versions"
+
+
+def namespaced(key):
+    """
+    Prefixes an image key or id with the tenant of the current request.
+
+    The tenant and image id form the hash tag of the key, ``{tenant:id}``,
+    so that all keys of an image land on the same Redis Cluster shard.
+    """
+    img_id = image_id(key)
+    return f"{{{current_tenant()}:{img_id}}}{key[len(img_id):]}"
+
+
+def tenant_of(img_id):
+    """Returns the tenant of a namespaced image id."""
+    return img_id.lstrip("{").split(":", 1)[0]
+
+
+def image_keys(img_id):
+    """Returns every key that can be derived from a namespaced image id."""
+    return [f"{img_id}{suffix}" for suffix in IMAGE_KEY_SUFFIXES]
+
+
+def image_id(key):
+    """Returns the image id a key was derived from."""
+    # Longest first, as "_clahe" is also the end of "_resized_clahe"
+    for suffix in sorted(IMAGE_KEY_SUFFIXES, key=len, reverse=True):
+        if suffix and key.endswith(suffix):
+            return key[: -len(suffix)]
+    return key
+
+
+def exists(key):
+    return backend.exists(namespaced(key))
+
+
+def load(key, touch=True):
+    """
+    Reads a key of the current tenant, refreshing the TTL and access statistics of its image.
+
+    Args:
+        key (str): The key to read.
+        touch (bool): Whether the read counts as an access of the image.
+
+    Returns:
+        bytes | None: The stored value, or None if the key does not exist.
+
+    """
+    value = backend.get(namespaced(key))
+    if value is not None and touch:
+        touch_image(image_id(key))
+    return value
+
+
+def load_array(key, touch=True, replica=False):
+    """
+    Reads an array stored with ``save_image_data``.
+
+    The disk backend returns a read-only memory-mapped array.
+
+    Args:
+        key (str): The key to read.
+        touch (bool): Whether the read counts as an access of the image.
+        replica (bool): Whether the read may be served by a Redis replica.
+
+    Returns:
+        np.ndarray | None: The stored array, or None if the key does not exist.
+
+    """
+    value = backend.get_array(namespaced(key), replica=replica)
+    if value is not None and touch:
+        touch_image(image_id(key))
+    return value
+
+
+def touch_image(img_id):
+    """Refreshes the TTL of an image's keys and records the access."""
+    _touch(namespaced(img_id))
+
+
+def _touch(img_id):
+    backend.expire(image_keys(img_id), REDIS_EXPIRE_SEC)
+    backend.hset(LAST_ACCESS, {img_id: time.time()})
+    backend.hincrby(HITS, img_id, 1)
+
+
+def _nbytes(value):
+    return value.nbytes if isinstance(value, np.ndarray) else len(value)
+
+
+def save_image_data(img_id, values):
+    """
+    Writes keys of an image in one batch and accounts for their size.
+
+    All keys of the image get their TTL refreshed, and images are evicted if
+    the write takes the tenant over its quota or the store over its memory
+    budget. The written image is never evicted by its own write.
+
+    Args:
+        img_id (str): The id of the image the keys belong to.
+        values (dict[str, bytes | np.ndarray]): The keys to write and their values.
+
+    Returns:
+        list[str]: The ids of the images evicted to make room.
+
+    """
+    img_id = namespaced(img_id)
+    values = {namespaced(key): value for key, value in values.items()}
+    keys = list(values)
+    previous = backend.hmget(KEY_BYTES, keys)
+    sizes = {key: _nbytes(value) for key, value in values.items()}
+    delta = sum(sizes.values()) - sum(int(x or 0) for x in previous)
+
+    backend.set_many(values, ttl=REDIS_EXPIRE_SEC)
+    backend.expire(
+        [key for key in image_keys(img_id) if key not in values],
+        REDIS_EXPIRE_SEC,
+    )
+    metadata = f"{img_id}_metadata"
+    if metadata in values and previous[keys.index(metadata)] is None:
+        backend.hincrby(CATALOG_VERSIONS, tenant_of(img_id), 1)
+    backend.hset(KEY_BYTES, sizes)
+    backend.hincrby(IMAGE_BYTES, img_id, delta)
+    backend.hset(LAST_ACCESS, {img_id: time.time()})
+    return enforce_budget(protect=img_id)
+
+
+def save_value(key, value, ttl):
+    """Writes a key shared by all tenants, e.g. a cache entry."""
+    if isinstance(value, str):
+        value = value.encode("utf8")
+    backend.set_many({key: value}, ttl=ttl)
+
+
+def load_value(key):
+    """Reads a key written with ``save_value``."""
+    return backend.get(key)
+
+
+def delete_value(key):
+    backend.delete([key])
+
+
+def value_exists(key):
+    return backend.exists(key)
+
+
+def delete_image(img_id):
+    """Deletes every key of an image of the current tenant."""
+    _delete(namespaced(img_id))
+
+
+def _delete(img_id):
+    keys = image_keys(img_id)
+    backend.delete(keys)
+    backend.hincrby(CATALOG_VERSIONS, tenant_of(img_id), 1)
+    backend.hdel(KEY_BYTES, keys)
+    for name in [IMAGE_BYTES, LAST_ACCESS, HITS]:
+        backend.hdel(name, [img_id])
+
+
+def list_images():
+    """Returns the ids of all images of the current tenant."""
+    prefix = f"{{{current_tenant()}:"
+    return [
+        image_id(key)[len(prefix) : -1]
+        for key in backend.scan(f"{prefix}*}}_metadata")
+    ]
+
+
+def catalog_version():
+    """Returns the version of the current tenant's catalog of images."""
+    version = backend.hmget(CATALOG_VERSIONS, [current_tenant()])[0]
+    return int(version or 0)
+
+
+_last_prune = 0
+
+
+def _prune_expired(interval=60):
+    """Drops images whose metadata expired, along with their leftover keys."""
+    global _last_prune
+    # Checks every image of the store, so at most once per interval
+    if time.time() - _last_prune < interval:
+        return
+    _last_prune = time.time()
+    img_ids = list(backend.hgetall(IMAGE_BYTES))
+    found = backend.exists_many([f"{img_id}_metadata" for img_id in img_ids])
+    for img_id, found in zip(img_ids, found):
+        if not found:
+            _delete(img_id)
+
+
+def _evict(sizes, limit, protect):
+    scores = backend.hgetall(
+        HITS if STORAGE_EVICTION_POLICY == "lfu" else LAST_ACCESS
+    )
+    candidates = sorted(
+        (img_id for img_id in sizes if img_id != protect),
+        key=lambda img_id: float(scores.get(img_id, 0)),
+    )
+    total = sum(sizes.values())
+    evicted = []
+    for img_id in candidates:
+        if total <= limit:
+            break
+        _delete(img_id)
+        total -= sizes[img_id]
+        evicted.append(img_id)
+    return evicted
+
+
+def enforce_budget(protect=None):
+    """
+    Evicts whole images until their tenant fits in its quota and the store in its budget.
+
+    A tenant over ``TENANT_QUOTA_BYTES`` only loses its own images. Victims
+    are chosen by the least recent access (``lru``) or the fewest reads
+    (``lfu``), according to ``STORAGE_EVICTION_POLICY``.
+
+    Args:
+        protect (str, optional): A namespaced image id that must not be evicted.
+
+    Returns:
+        list[str]: The namespaced ids of the evicted images.
+
+    """
+    _prune_expired()
+    sizes = {k: int(v) for k, v in backend.hgetall(IMAGE_BYTES).items()}
+    evicted = []
+    if protect and TENANT_QUOTA_BYTES > 0:
+        tenant = tenant_of(protect)
+        tenant_sizes = {
+            k: v for k, v in sizes.items() if tenant_of(k) == tenant
+        }
+        evicted += _evict(tenant_sizes, TENANT_QUOTA_BYTES, protect)
+    if STORAGE_BUDGET_BYTES > 0:
+        sizes = {k: v for k, v in sizes.items() if k not in evicted}
+        evicted += _evict(sizes, STORAGE_BUDGET_BYTES, protect)
+    if evicted:
+        print(f"Storage quota exceeded, evicted {len(evicted)} image(s).")
+    return evicted
+
+
+def storage_usage():
+    """
+    Summarizes the current memory usage of the image store.
+
+    Returns:
+        dict: Byte totals, the configured budget and quota, usage per tenant
+            and the largest images.
+
+    """
+    _prune_expired(interval=0)
+    sizes = {k: int(v) for k, v in backend.hgetall(IMAGE_BYTES).items()}
+    tenants = {}
+    for img_id, size in sizes.items():
+        tenants[tenant_of(img_id)] = tenants.get(tenant_of(img_id), 0) + size
+    largest = sorted(sizes.items(), key=lambda item: item[1], reverse=True)
+    return {
+        "backend": type(backend).__name__,
+        "images": len(sizes),
+        "image_bytes": sum(sizes.values()),
+        "budget_bytes": STORAGE_BUDGET_BYTES,
+        "tenant_quota_bytes": TENANT_QUOTA_BYTES,
+        "eviction_policy": STORAGE_EVICTION_POLICY,
+        "backend_used_bytes": backend.memory_usage(),
+        "tenants": tenants,
+        "largest": [{"id": k, "bytes": v} for k, v in largest[:10]],
+    }
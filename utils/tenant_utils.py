@@ -0,0 +1,151 @@
+import contextlib, contextvars, hashlib, hmac, re, time, uuid
+import flask
+from constants import (
+    TENANT_COOKIE,
+    TENANT_HEADER,
+    TENANT_JOB_LEASE_SEC,
+    TENANT_MAX_JOBS,
+    TENANT_SECRET,
+    DEFAULT_TENANT,
+)
+from utils.storage_backends import backend
+
+_tenant = contextvars.ContextVar("tenant", default=DEFAULT_TENANT)
+_TENANT_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+def _jobs_key(tenant):
+    # Deadlines of the running jobs of a tenant, by lease id
+    return f"tenant_jobs_{tenant}"
+
+
+class TenantQuotaExceeded(Exception):
+    """Raised when a tenant starts more jobs than ``TENANT_MAX_JOBS``."""
+
+
+def current_tenant():
+    """Returns the tenant of the current request or background job."""
+    return _tenant.get()
+
+
+def tenant_namespace(identity):
+    """
+    Derives the storage namespace of a session or user.
+
+    The namespace is keyed by ``TENANT_SECRET``, so it can be reported
+    without giving away the cookie that identifies the session.
+
+    Args:
+        identity (str): The session cookie or user name.
+
+    Returns:
+        str: The namespace, 32 hex digits.
+
+    """
+    digest = hmac.new(
+        TENANT_SECRET.encode("utf8"), identity.encode("utf8"), hashlib.sha256
+    )
+    return digest.hexdigest()[:32]
+
+
+def register_tenants(server):
+    """
+    Identifies the tenant of every request.
+
+    Tenants are users when ``TENANT_HEADER`` names a header set by an
+    authenticating proxy, browser sessions identified by a cookie otherwise.
+
+    Args:
+        server (flask.Flask): The server to configure.
+
+    """
+
+    @server.before_request
+    def identify_tenant():
+        user = (
+            flask.request.headers.get(TENANT_HEADER) if TENANT_HEADER else None
+        )
+        if user:
+            identity = user
+        else:
+            identity = flask.request.cookies.get(TENANT_COOKIE, "")
+            if not _TENANT_ID.match(identity):
+                identity = uuid.uuid4().hex
+                flask.g.new_tenant = identity
+        flask.g.tenant_token = _tenant.set(tenant_namespace(identity))
+
+    @server.teardown_request
+    def reset_tenant(exc):
+        # Threads serve many requests, none should inherit another's tenant
+        if "tenant_token" in flask.g:
+            _tenant.reset(flask.g.tenant_token)
+
+    @server.after_request
+    def set_tenant_cookie(response):
+        if "new_tenant" in flask.g:
+            response.set_cookie(
+                TENANT_COOKIE,
+                flask.g.new_tenant,
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
+
+
+def _live_leases(tenant, now):
+    key = _jobs_key(tenant)
+    leases = {k: float(v) for k, v in backend.hgetall(key).items()}
+    backend.hdel(key, [k for k, deadline in leases.items() if deadline <= now])
+    return [k for k, deadline in leases.items() if deadline > now]
+
+
+def acquire_job_slot(tenant=None):
+    """
+    Takes one of the tenant's ``TENANT_MAX_JOBS`` concurrent job slots.
+
+    Slots are leases that expire after ``TENANT_JOB_LEASE_SEC`` unless
+    renewed, so a worker killed mid-job does not hold its slot forever.
+
+    Args:
+        tenant (str, optional): The tenant, the current one by default.
+
+    Returns:
+        tuple[str, str]: The tenant and the lease id, to renew or release the slot with.
+
+    Raises:
+        TenantQuotaExceeded: If all of the tenant's slots are in use.
+
+    """
+    tenant = tenant or current_tenant()
+    lease = uuid.uuid4().hex
+    now = time.time()
+    backend.hset(_jobs_key(tenant), {lease: now + TENANT_JOB_LEASE_SEC})
+    # Concurrent acquisitions may both back off, but never both succeed
+    if len(_live_leases(tenant, now)) > TENANT_MAX_JOBS:
+        release_job_slot((tenant, lease))
+        raise TenantQuotaExceeded(
+            f"Too many jobs running, at most {TENANT_MAX_JOBS} at a time."
+        )
+    return tenant, lease
+
+
+def renew_job_slot(slot):
+    """Extends the lease of a job slot by ``TENANT_JOB_LEASE_SEC``."""
+    tenant, lease = slot
+    deadline = time.time() + TENANT_JOB_LEASE_SEC
+    backend.hset(_jobs_key(tenant), {lease: deadline})
+
+
+def release_job_slot(slot):
+    tenant, lease = slot
+    backend.hdel(_jobs_key(tenant), [lease])
+
+
+@contextlib.contextmanager
+def job_slot(tenant=None):
+    """Holds one of the tenant's job slots for the duration of a block."""
+    slot = acquire_job_slot(tenant)
+    try:
+        yield
+    finally:
+        release_job_slot(slot)